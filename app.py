@@ -1,15 +1,11 @@
 # app.py
 # Main FastAPI application for email classification
+# Serves main.py's app, so both entry points share its limits, deadlines and options
 # Author: Dhanush
 # Date: April 19, 2025
 
-from fastapi import FastAPI
 import uvicorn
-from api import classify_email_endpoint
-
-app = FastAPI()
-
-app.post("/classify")(classify_email_endpoint)
+from main import app
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,325 @@
+# benchmark.py
+# Reproducible performance benchmarks on a seeded synthetic corpus
+# Measures throughput, per-email latency percentiles and peak memory; saves JSON per run
+# Author: Dhanush
+# Date: April 19, 2025
+
+import os
+import gc
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import subprocess
+import tracemalloc
+import logging
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+from synthetic_emails import generate_emails
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SUITES = {}
+
+def suite(name: str):
+    def register(fn):
+        SUITES[name] = fn
+        return fn
+    return register
+
+def latency_stats(samples: List[float]) -> Dict:
+    ordered = sorted(samples)
+    if not ordered:
+        return {"count": 0}
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": ordered[-1] * 1000
+    }
+
+def peak_memory(fn: Callable, items: List) -> int:
+    """Peak Python heap allocation in bytes while running fn over items (traced separately from timings)."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        for item in items:
+            fn(item)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def measure(fn: Callable, items: List, batched: bool = False, memory_items: int = 50) -> Dict:
+    # batched items are lists of emails; throughput counts the emails, short last batch included
+    samples = []
+    start = time.perf_counter()
+    for item in items:
+        t0 = time.perf_counter()
+        fn(item)
+        samples.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    return {
+        "items": len(items),
+        "seconds": elapsed,
+        "emails_per_second": (sum(map(len, items)) if batched else len(items)) / elapsed if elapsed else None,
+        "latency": latency_stats(samples),
+        "peak_traced_bytes": peak_memory(fn, items[:memory_items])
+    }
+
+def corpus(args, lines: int = None, density: float = None) -> List[str]:
+    emails = generate_emails(args.n, seed=args.seed, lines=lines or args.lines[0], density=density if density is not None else args.densities[0])
+    return [email["email"] for email in emails]
+
+@suite("mask_pii")
+def bench_mask_pii(args) -> Dict:
+    from pipeline import model_holder
+    from utils import mask_pii
+    nlp = model_holder.nlp
+    results = {}
+    for lines in args.lines:
+        for density in args.densities:
+            texts = corpus(args, lines, density)
+            results[f"lines={lines},density={density}"] = measure(lambda text: mask_pii(text, nlp), texts)
+    return results
+
+@suite("mask_depth")
+def bench_mask_depth(args) -> Dict:
+    """mask_pii latency per masking tier: regex only, gated NER, NER on every line."""
+    from pipeline import model_holder
+    from utils import mask_pii, MASK_DEPTHS
+    nlp = model_holder.nlp
+    texts = corpus(args)
+    return {depth: measure(lambda text: mask_pii(text, nlp, depth=depth), texts) for depth in MASK_DEPTHS}
+
+# Inputs that made backtracking patterns super-linear: long runs of the characters
+# email and phone patterns accept, pasted logs and CSV dumps
+ADVERSARIAL_UNITS = {
+    "dotted_run": "a.",
+    "dashed_run": "a-",
+    "digit_dash_run": "1234-",
+    "digit_space_run": "12 34-56 ",
+    "at_run": "a@b.",
+    "capitalized_run": "Aaaa ",
+    "log_dump": "2024-05-01 12:00:01,123 host-17 [worker-3] 10.0.0.1 - 5551234567 GET /a.b-c 200\n",
+    "csv_dump": "1234,5678,9012,3456,12/25,123,\n",
+}
+
+@suite("adversarial")
+def bench_adversarial(args) -> Dict:
+    """Regex stage time per character as adversarial inputs grow; flat ns/char means linear time."""
+    from utils import find_pii
+    results = {}
+    for name, unit in ADVERSARIAL_UNITS.items():
+        sizes = {}
+        for size in args.adversarial_sizes:
+            text = unit * (size // len(unit))
+            timings = []
+            for _ in range(3):
+                start = time.perf_counter()
+                find_pii(text)
+                timings.append(time.perf_counter() - start)
+            sizes[str(len(text))] = {"seconds": min(timings), "ns_per_char": min(timings) / len(text) * 1e9}
+        per_char = [entry["ns_per_char"] for entry in sizes.values()]
+        # Growth of ns/char from the smallest to the largest input: ~1 for linear, ~size ratio for quadratic
+        results[name] = {"sizes": sizes, "growth": per_char[-1] / per_char[0]}
+        if results[name]["growth"] > 2:
+            logger.warning(f"{name}: regex time per character grew {results[name]['growth']:.1f}x")
+    return results
+
+@suite("classify_email")
+def bench_classify_email(args) -> Dict:
+    from pipeline import classify_email
+    return measure(classify_email, corpus(args))
+
+@suite("classify_emails")
+def bench_classify_emails(args) -> Dict:
+    from pipeline import classify_emails
+    texts = corpus(args)
+    batches = [texts[i:i + args.batch_size] for i in range(0, len(texts), args.batch_size)]
+    result = measure(classify_emails, batches, batched=True, memory_items=2)
+    result["batch_size"] = args.batch_size
+    return result
+
+@suite("mask_dataset")
+def bench_mask_dataset(args) -> Dict:
+    # Dataset job path of mask_pii.py (regex + nlp.pipe over a chunk of rows)
+    import mask_pii
+    texts = corpus(args)
+    chunks = [texts[i:i + args.batch_size] for i in range(0, len(texts), args.batch_size)]
+    result = measure(lambda chunk: mask_pii.mask_texts(chunk, mask_pii.nlp), chunks, batched=True, memory_items=2)
+    result["chunk_size"] = args.batch_size
+    return result
+
+@suite("response_modes")
+def bench_response_modes(args) -> Dict:
+    """Bytes and serialization time per /classify response mode: FastAPI's default encoder vs orjson, raw and gzipped."""
+    import gzip
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse, ORJSONResponse
+    from pipeline import classify_emails
+    from responses import shape_result, RESPONSE_MODES
+    # Longest configured bodies, where echoing the email costs most
+    results = classify_emails(corpus(args, lines=max(args.lines)))
+    encoders = {
+        "fastapi_json": lambda payload: JSONResponse(jsonable_encoder(payload)).body,
+        "orjson": lambda payload: ORJSONResponse(payload).body,
+        "orjson_gzip": lambda payload: gzip.compress(ORJSONResponse(payload).body, compresslevel=6),
+    }
+    report = {}
+    for mode in RESPONSE_MODES:
+        shaped = [shape_result(result, mode) for result in results]
+        report[mode] = {}
+        for name, encode in encoders.items():
+            start = time.perf_counter()
+            sizes = [len(encode(payload)) for payload in shaped]
+            elapsed = time.perf_counter() - start
+            report[mode][name] = {
+                "mean_bytes": sum(sizes) / len(sizes),
+                "mean_serialize_us": elapsed / len(shaped) * 1e6
+            }
+        logger.info(f"{mode}: {report[mode]['fastapi_json']['mean_bytes']:.0f} B / {report[mode]['fastapi_json']['mean_serialize_us']:.1f} us default, "
+                    f"{report[mode]['orjson']['mean_serialize_us']:.1f} us orjson, {report[mode]['orjson_gzip']['mean_bytes']:.0f} B gzipped")
+    return report
+
+def _smaps_rollup() -> Dict:
+    fields = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    return {
+        "rss_bytes": fields.get("Rss", 0),
+        "pss_bytes": fields.get("Pss", 0),
+        "private_bytes": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)
+    }
+
+def _memory_worker(path, texts, barrier, queue):
+    from pipeline import load_model
+    if path is not None:
+        load_model(path).predict(texts)
+    # Measure while every worker holds the model, so shared pages are split between them
+    barrier.wait()
+    queue.put(_smaps_rollup())
+    barrier.wait()
+
+@suite("worker_memory")
+def bench_worker_memory(args) -> Dict:
+    """Per-worker memory with each worker loading the pickled model vs the memory-mapped artifact."""
+    import multiprocessing
+    ctx = multiprocessing.get_context("spawn")
+    texts = corpus(args)[:20]
+    results = {}
+    for label, path in (("no_model", None), ("pickled", args.model_pkl), ("mmap", args.model_mmap)):
+        if path is not None and not os.path.exists(path):
+            logger.warning(f"Skipping {label}: {path} not found")
+            continue
+        barrier, queue = ctx.Barrier(args.memory_workers), ctx.Queue()
+        workers = [ctx.Process(target=_memory_worker, args=(path, texts, barrier, queue)) for _ in range(args.memory_workers)]
+        for worker in workers:
+            worker.start()
+        samples = [queue.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        results[label] = {"path": path, "workers": args.memory_workers}
+        for key in ("rss_bytes", "pss_bytes", "private_bytes"):
+            results[label][f"mean_{key}"] = sum(sample[key] for sample in samples) / len(samples)
+    if "pickled" in results and "mmap" in results:
+        results["pss_saving_per_worker_bytes"] = results["pickled"]["mean_pss_bytes"] - results["mmap"]["mean_pss_bytes"]
+        results["private_saving_per_worker_bytes"] = results["pickled"]["mean_private_bytes"] - results["mmap"]["mean_private_bytes"]
+        logger.info(f"Memory-mapped artifact saves {results['pss_saving_per_worker_bytes'] / 1e6:.1f} MB PSS per worker")
+    return results
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+def compare(old_path: str, new_path: str):
+    """Prints throughput and p95 latency change between two result files."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def flatten(results, prefix=""):
+        for key, value in results.items():
+            if isinstance(value, dict) and "latency" in value:
+                yield prefix + key, value
+            elif isinstance(value, dict):
+                yield from flatten(value, prefix + key + "/")
+
+    old_flat = dict(flatten(old["suites"]))
+    print(f"{'benchmark':<50} {'emails/s old':>12} {'emails/s new':>12} {'p95 old':>9} {'p95 new':>9}")
+    for name, result in flatten(new["suites"]):
+        before = old_flat.get(name)
+        if before is None:
+            continue
+        print(f"{name:<50} {before['emails_per_second']:>12.1f} {result['emails_per_second']:>12.1f} "
+              f"{before['latency']['p95_ms']:>8.2f}ms {result['latency']['p95_ms']:>8.2f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run performance benchmarks")
+    parser.add_argument("--suites", default=",".join(SUITES), help=f"comma-separated subset of {','.join(SUITES)}")
+    parser.add_argument("--n", type=int, default=500, help="synthetic emails per run")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--lines", default="6,30", help="comma-separated body lengths (lines) for mask_pii")
+    parser.add_argument("--densities", default="0.1,0.5", help="comma-separated PII densities for mask_pii")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--adversarial-sizes", default="10000,40000,160000", help="comma-separated input lengths for adversarial")
+    parser.add_argument("--model-pkl", default="rf_model.pkl", help="pickled model for worker_memory")
+    parser.add_argument("--model-mmap", default="rf_model_mmap", help="memory-mapped artifact for worker_memory")
+    parser.add_argument("--memory-workers", type=int, default=4)
+    parser.add_argument("--output-dir", default="bench_results")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    args.lines = [int(v) for v in args.lines.split(",")]
+    args.densities = [float(v) for v in args.densities.split(",")]
+    args.adversarial_sizes = [int(v) for v in args.adversarial_sizes.split(",")]
+    names = [name.strip() for name in args.suites.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SUITES]
+    if unknown:
+        logger.error(f"Unknown suites: {unknown}")
+        exit(1)
+
+    from pipeline import model_holder
+    model_holder.warm_up()
+
+    results = {}
+    for name in names:
+        logger.info(f"Running {name}...")
+        results[name] = SUITES[name](args)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "params": {"n": args.n, "seed": args.seed, "lines": args.lines, "densities": args.densities, "batch_size": args.batch_size}
+        },
+        "suites": results
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = os.path.join(args.output_dir, f"{report['meta']['commit']}_{datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Saved results to {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# cache.py
+# Content-addressed cache of classification results
+# Keyed by a hash of the model version and the email body; LRU with entry/byte budget and TTL
+# Author: Dhanush
+# Date: April 19, 2025
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+from metrics import REGISTRY as metrics
+
+# Off unless EMAIL_CACHE_ENTRIES is set, e.g. 10000
+CACHE_ENTRIES = int(os.environ.get("EMAIL_CACHE_ENTRIES", 0))
+CACHE_BYTES = int(os.environ.get("EMAIL_CACHE_BYTES", 64 * 1024 * 1024))
+CACHE_TTL = float(os.environ.get("EMAIL_CACHE_TTL", 3600))
+
+class ResultCache:
+    """Thread-safe LRU of masked text, entities and category per (model version, email body)."""
+
+    def __init__(self, max_entries: int = CACHE_ENTRIES, max_bytes: int = CACHE_BYTES, ttl: float = CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def make_key(email: str, model_version: str) -> str:
+        return hashlib.sha256(f"{model_version}\0{email}".encode("utf-8", "surrogatepass")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                metrics.inc("email_cache_misses_total")
+                return None
+            expires_at, size, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                metrics.inc("email_cache_expirations_total")
+                metrics.inc("email_cache_misses_total")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            metrics.inc("email_cache_hits_total")
+            return value
+
+    def put(self, key: str, value: Dict):
+        size = len(key) + len(json.dumps(value, default=str))
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+                metrics.inc("email_cache_evictions_total")
+
+    def get_result(self, email: str, model_version: str) -> Optional[Dict]:
+        value = self.get(self.make_key(email, model_version))
+        if value is None:
+            return None
+        return {"input_email_body": email, **value}
+
+    def put_result(self, email: str, model_version: str, result: Dict):
+        # The body is implied by the key, so only the derived fields are stored
+        self.put(self.make_key(email, model_version), {key: value for key, value in result.items() if key != "input_email_body"})
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
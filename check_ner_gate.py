@@ -0,0 +1,50 @@
+# check_ner_gate.py
+# Checks that the NER pre-filter leaves masking output unchanged on a sample of emails.csv
+# Author: Dhanush
+# Date: April 19, 2025
+
+import argparse
+import logging
+import pandas as pd
+from pipeline import model_holder
+from utils import mask_pii, ner_stats
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare masking with and without the NER gate")
+    parser.add_argument("--input", default="emails.csv")
+    parser.add_argument("--rows", type=int, default=1000, help="sample size")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    try:
+        df = pd.read_csv(args.input, usecols=["email"])
+        sample = df["email"].sample(n=min(args.rows, len(df)), random_state=args.seed)
+        logger.info(f"Comparing gated and ungated masking on {len(sample)} rows")
+    except Exception as e:
+        logger.error(f"Error loading dataset: {e}")
+        exit(1)
+
+    nlp = model_holder.nlp
+    mismatches = []
+    for idx, text in sample.items():
+        gated = mask_pii(text, nlp, gate=True)
+        ungated = mask_pii(text, nlp, gate=False)
+        if gated != ungated:
+            mismatches.append((idx, gated[0], ungated[0]))
+
+    stats = ner_stats.snapshot()
+    # The ungated pass sends every candidate line, so half of lines_seen belongs to each pass
+    logger.info(f"Gated pass skipped {stats['ner_skipped']} of {stats['lines_seen'] // 2} candidate lines")
+
+    for idx, gated, ungated in mismatches[:10]:
+        logger.warning(f"Row {idx} differs:\n  gated:   {gated!r}\n  ungated: {ungated!r}")
+    if mismatches:
+        logger.info(f"Check complete. {len(mismatches)} rows differ.")
+        exit(1)
+    logger.info("Check complete. Masking output unchanged.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+# datastore.py
+# Columnar store for the raw and masked email corpora (Arrow IPC files)
+# Reads are memory-mapped and project only the requested columns; single rows are
+# found through the record batch offsets, without scanning or parsing the whole file
+# Author: Dhanush
+# Date: April 19, 2025
+
+import os
+import bisect
+import argparse
+import logging
+import pandas as pd
+import pyarrow as pa
+from typing import Iterator, List, Optional
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+STORE_SUFFIX = ".arrow"
+# Rows per record batch: the unit a row lookup has to touch
+BATCH_ROWS = 8192
+
+def store_path(path: str) -> str:
+    """emails.csv -> emails.arrow; store paths are returned unchanged."""
+    if path.endswith(STORE_SUFFIX):
+        return path
+    return os.path.splitext(path)[0] + STORE_SUFFIX
+
+class ColumnStore:
+    """Read-only, memory-mapped view of an Arrow IPC file written by write_store."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._source = pa.memory_map(path, "r")
+        self._reader = pa.ipc.open_file(self._source)
+        self.columns = self._reader.schema.names
+        # Batch headers only; with a memory map no column data is read here
+        sizes = [self._reader.get_batch(i).num_rows for i in range(self._reader.num_record_batches)]
+        self._starts = [0]
+        for size in sizes:
+            self._starts.append(self._starts[-1] + size)
+        self.num_rows = self._starts[-1]
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.num_rows, len(self.columns)
+
+    def close(self):
+        self._source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _select(self, batch, columns: Optional[List[str]]):
+        return batch if columns is None else batch.select(columns)
+
+    def read(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        table = self._reader.read_all()
+        return self._select(table, columns).to_pandas()
+
+    def rows(self, indices: List[int], columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """The given row numbers (missing ones skipped), indexed by row number."""
+        frames = []
+        for index in sorted(set(indices)):
+            if not 0 <= index < self.num_rows:
+                continue
+            batch_index = bisect.bisect_right(self._starts, index) - 1
+            batch = self._select(self._reader.get_batch(batch_index), columns)
+            frame = batch.slice(index - self._starts[batch_index], 1).to_pandas()
+            frame.index = [index]
+            frames.append(frame)
+        if not frames:
+            return pd.DataFrame(columns=columns or self.columns)
+        return pd.concat(frames)
+
+    def iter_batches(self, columns: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+        for i in range(self._reader.num_record_batches):
+            frame = self._select(self._reader.get_batch(i), columns).to_pandas()
+            frame.index = pd.RangeIndex(self._starts[i], self._starts[i + 1])
+            yield frame
+
+def _schema(df: pd.DataFrame) -> pa.Schema:
+    # Text columns stay strings even when a chunk holds only missing values
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    return pa.schema([pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field for field in schema])
+
+def write_store(chunks, path: str, batch_rows: int = BATCH_ROWS) -> int:
+    """Writes an iterable of DataFrames to an uncompressed Arrow IPC file; returns the row count."""
+    tmp_path = path + ".tmp"
+    rows = 0
+    writer = None
+    try:
+        for chunk in chunks:
+            if writer is None:
+                schema = _schema(chunk)
+                writer = pa.ipc.new_file(tmp_path, schema)
+            table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            for batch in table.to_batches(max_chunksize=batch_rows):
+                writer.write_batch(batch)
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError(f"No data to write to {path}")
+    os.replace(tmp_path, path)
+    return rows
+
+def convert_csv(csv_path: str, path: Optional[str] = None, batch_rows: int = BATCH_ROWS) -> str:
+    """Builds the store for csv_path, parsing the CSV once in chunks."""
+    path = path or store_path(csv_path)
+    rows = write_store(pd.read_csv(csv_path, chunksize=batch_rows), path, batch_rows)
+    logger.info(f"Wrote {rows} rows of {csv_path} to {path}")
+    return path
+
+def open_store(path: str) -> Optional[ColumnStore]:
+    """The store for path: the .arrow file itself, or one next to a CSV that is at least as new."""
+    store = store_path(path)
+    if not os.path.exists(store):
+        return None
+    if store != path and os.path.exists(path) and os.path.getmtime(store) < os.path.getmtime(path):
+        logger.warning(f"{store} is older than {path}; reading the CSV (rebuild with python datastore.py {path})")
+        return None
+    return ColumnStore(store)
+
+def read_columns(path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Columns of a dataset from its store when there is one, otherwise from the CSV."""
+    store = open_store(path)
+    if store is None:
+        return pd.read_csv(path, usecols=columns)
+    with store:
+        return store.read(columns)
+
+def read_rows(path: str, indices: List[int], columns: Optional[List[str]] = None) -> pd.DataFrame:
+    store = open_store(path)
+    if store is None:
+        df = pd.read_csv(path, usecols=columns)
+        return df.loc[[index for index in indices if index in df.index]]
+    with store:
+        return store.rows(indices, columns)
+
+def iter_chunks(path: str, chunksize: int, columns: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+    """Dataset in chunks of about chunksize rows (store batches are split or merged to fit)."""
+    store = open_store(path)
+    if store is None:
+        yield from pd.read_csv(path, chunksize=chunksize, usecols=columns)
+        return
+    with store:
+        pending = []
+        size = 0
+        for frame in store.iter_batches(columns):
+            pending.append(frame)
+            size += len(frame)
+            while size >= chunksize:
+                merged = pd.concat(pending)
+                yield merged.iloc[:chunksize]
+                rest = merged.iloc[chunksize:]
+                pending, size = ([rest], len(rest)) if len(rest) else ([], 0)
+        if pending:
+            yield pd.concat(pending)
+
+def dataset_shape(path: str) -> tuple[int, int]:
+    store = open_store(path)
+    if store is None:
+        return read_columns(path).shape
+    with store:
+        return store.shape
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert CSV corpora to memory-mappable columnar stores")
+    parser.add_argument("csv", nargs="*", default=["emails.csv", "emails_masked.csv"])
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS)
+    args = parser.parse_args()
+
+    for csv_path in args.csv:
+        try:
+            convert_csv(csv_path, batch_rows=args.batch_rows)
+        except Exception as e:
+            logger.error(f"Error converting {csv_path}: {e}")
+            exit(1)
@@ -0,0 +1,260 @@
+# dedup.py
+# MinHash/LSH index of masked emails for reusing classifications of near-duplicate tickets
+# Monitoring alerts and web-form tickets differ only in names, numbers and timestamps,
+# which masking and digit normalization remove; what is left is near-identical text
+# Author: Dhanush
+# Date: April 19, 2025
+
+import os
+import re
+import time
+import zlib
+import fcntl
+import heapq
+import hashlib
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import List, Optional
+from metrics import REGISTRY as metrics
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Indexed emails per process; 0 disables near-duplicate reuse
+DEDUP_ENTRIES = int(os.environ.get("EMAIL_DEDUP_ENTRIES", 0))
+# Estimated Jaccard similarity of word shingles above which a stored category is reused
+DEDUP_THRESHOLD = float(os.environ.get("EMAIL_DEDUP_THRESHOLD", 0.9))
+# Empty string keeps the index in memory only
+DEDUP_PATH = os.environ.get("EMAIL_DEDUP_PATH", "dedup_index.npz")
+# A background thread saves after this many additions, or this many seconds after the last save
+DEDUP_SAVE_EVERY = int(os.environ.get("EMAIL_DEDUP_SAVE_EVERY", 1000))
+DEDUP_SAVE_INTERVAL = float(os.environ.get("EMAIL_DEDUP_SAVE_INTERVAL", 60))
+# Saved entries added per hold of the index lock while merging
+MERGE_CHUNK = 1000
+
+NUM_PERM = 128
+BANDS = 32  # 4 rows per band: pairs at Jaccard 0.9 collide in some band with probability ~1, at 0.5 ~0.87
+SHINGLE_WORDS = 3
+_MERSENNE = (1 << 31) - 1
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, _MERSENNE, size=(NUM_PERM, 1)).astype(np.uint64)
+_PERM_B = _rng.randint(0, _MERSENNE, size=(NUM_PERM, 1)).astype(np.uint64)
+
+WORD_REGEX = re.compile(r'\w+')
+DIGITS_REGEX = re.compile(r'\d+')
+
+def shingles(masked_email: str) -> set:
+    # Digit runs collapse to one symbol so ticket numbers and timestamps do not count as differences
+    words = WORD_REGEX.findall(DIGITS_REGEX.sub("0", masked_email.lower()))
+    if len(words) <= SHINGLE_WORDS:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+def signature(masked_email: str) -> Optional[np.ndarray]:
+    """MinHash signature (NUM_PERM uint32 values), or None for an email with no words."""
+    items = shingles(masked_email)
+    if not items:
+        return None
+    # crc32 rather than hash(): signatures must be stable across processes and restarts
+    hashes = np.fromiter((zlib.crc32(item.encode("utf-8", "surrogatepass")) for item in items), dtype=np.uint64, count=len(items))
+    return ((_PERM_A * hashes + _PERM_B) % _MERSENNE).min(axis=1).astype(np.uint32)
+
+class DedupIndex:
+    """Bounded LRU of (MinHash signature -> category, confidence) with LSH banding for lookup.
+
+    Entries belong to one model version; a different version clears the index.
+    Each process running the pipeline keeps its own index. sync() merges with
+    whatever other processes saved to the same file, so workers share what
+    they learned across restarts. Saving runs on a background thread, never
+    on the request path.
+    """
+
+    def __init__(self, max_entries: int = DEDUP_ENTRIES, threshold: float = DEDUP_THRESHOLD,
+                 path: Optional[str] = DEDUP_PATH or None, save_every: int = DEDUP_SAVE_EVERY,
+                 save_interval: float = DEDUP_SAVE_INTERVAL):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.path = path
+        self.save_every = save_every
+        self.save_interval = save_interval
+        self.model_version = None
+        self._lock = threading.Lock()
+        self._save_due = threading.Event()
+        self._saver_pid = None
+        self._entries = OrderedDict()  # key -> [signature, category, confidence, used_at]
+        self._buckets = [{} for _ in range(BANDS)]  # band value -> set of keys
+        self._unsaved = 0
+
+    @staticmethod
+    def _bands(sig: np.ndarray) -> List[bytes]:
+        # Slices of the raw bytes: the same keys as per-band tobytes(), without an array per band
+        raw = sig.tobytes()
+        step = len(raw) // BANDS
+        return [raw[i:i + step] for i in range(0, len(raw), step)]
+
+    @staticmethod
+    def _key(sig: np.ndarray) -> str:
+        return hashlib.blake2b(sig.tobytes(), digest_size=8).hexdigest()
+
+    def _insert(self, key: str, entry: list):
+        if key in self._entries:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = entry
+        for bucket, band in zip(self._buckets, self._bands(entry[0])):
+            bucket.setdefault(band, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            evicted_key, (evicted_sig, *_) = self._entries.popitem(last=False)
+            for bucket, band in zip(self._buckets, self._bands(evicted_sig)):
+                keys = bucket[band]
+                keys.discard(evicted_key)
+                if not keys:
+                    del bucket[band]
+            metrics.inc("email_dedup_evictions_total")
+
+    def _clear(self):
+        self._entries.clear()
+        self._buckets = [{} for _ in range(BANDS)]
+        self._unsaved = 0
+
+    def use_version(self, model_version: str):
+        """Binds the index to a model version, loading the saved index on first use."""
+        if model_version == self.model_version:
+            return
+        with self._lock:
+            if model_version == self.model_version:
+                return
+            self._clear()
+            self.model_version = model_version
+        if self.path is not None:
+            try:
+                with open(self.path + ".lock", "a") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_SH)
+                    saved = self._read(model_version)
+                self._merge(saved, model_version)
+            except Exception as e:
+                logger.error(f"Error loading near-duplicate index from {self.path}: {e}")
+
+    def lookup(self, sig: Optional[np.ndarray]) -> Optional[tuple]:
+        """(category, confidence, similarity) of the most similar indexed email at or above threshold."""
+        if sig is None:
+            return None
+        best, best_similarity = None, self.threshold
+        with self._lock:
+            candidates = set()
+            for bucket, band in zip(self._buckets, self._bands(sig)):
+                candidates.update(bucket.get(band, ()))
+            for key in candidates:
+                similarity = float(np.mean(self._entries[key][0] == sig))
+                if similarity >= best_similarity:
+                    best, best_similarity = key, similarity
+            if best is not None:
+                entry = self._entries[best]
+                entry[3] = time.time()
+                self._entries.move_to_end(best)
+        metrics.inc("email_dedup_lookups_total", result="miss" if best is None else "hit")
+        return None if best is None else (entry[1], entry[2], best_similarity)
+
+    def add(self, sig: Optional[np.ndarray], category: str, confidence: Optional[float]):
+        if sig is None or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._insert(self._key(sig), [sig, category, confidence, time.time()])
+            self._unsaved += 1
+            due = self._unsaved >= self.save_every
+        if self.path is not None:
+            self._start_saver()
+            if due:
+                self._save_due.set()
+
+    def _start_saver(self):
+        # Per process: threads do not survive a fork
+        if self._saver_pid == os.getpid():
+            return
+        with self._lock:
+            if self._saver_pid == os.getpid():
+                return
+            self._saver_pid = os.getpid()
+        threading.Thread(target=self._save_loop, name="dedup-saver", daemon=True).start()
+
+    def _save_loop(self):
+        while True:
+            self._save_due.wait(self.save_interval)
+            self._save_due.clear()
+            if self._unsaved:
+                self.sync()
+
+    def _merge(self, saved: dict, model_version: str):
+        """Adds saved entries this process does not have, newest first, as least recently used, while there is room."""
+        missing = sorted(((key, entry) for key, entry in saved.items() if key not in self._entries),
+                         key=lambda item: item[1][3], reverse=True)
+        for start in range(0, len(missing), MERGE_CHUNK):
+            # Chunks keep lookups from waiting on a large merge
+            with self._lock:
+                if self.model_version != model_version:
+                    return
+                for key, entry in missing[start:start + MERGE_CHUNK]:
+                    if len(self._entries) >= self.max_entries:
+                        return
+                    if key not in self._entries:
+                        self._insert(key, entry)
+                        self._entries.move_to_end(key, last=False)
+
+    def sync(self):
+        """Merges this index with the saved file and writes the union back (newest entries win the size budget).
+
+        The index lock is held only to copy the local entries and to add saved
+        ones this process lacks; reading and writing the file happen without it.
+        """
+        if self.path is None:
+            return
+        try:
+            with open(self.path + ".lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                with self._lock:
+                    model_version = self.model_version
+                if model_version is None:
+                    return
+                saved = self._read(model_version)
+                self._merge(saved, model_version)
+                with self._lock:
+                    if self.model_version != model_version:
+                        return
+                    local = list(self._entries.items())
+                    self._unsaved = 0
+                merged = saved
+                for key, entry in local:
+                    if key not in merged or merged[key][3] < entry[3]:
+                        merged[key] = entry
+                self._write(heapq.nlargest(self.max_entries, merged.items(), key=lambda item: item[1][3]), model_version)
+        except Exception as e:
+            logger.error(f"Error saving near-duplicate index to {self.path}: {e}")
+
+    def _read(self, model_version: str) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with np.load(self.path, allow_pickle=False) as data:
+            if str(data["model_version"]) != model_version or data["signatures"].shape[1:] != (NUM_PERM,):
+                logger.info(f"Ignoring near-duplicate index {self.path} built for another model version")
+                return {}
+            confidences = [None if np.isnan(c) else float(c) for c in data["confidences"]]
+            return {
+                self._key(sig): [sig, str(category), confidence, float(used_at)]
+                for sig, category, confidence, used_at in zip(data["signatures"], data["categories"], confidences, data["used_at"])
+            }
+
+    def _write(self, entries: list, model_version: str):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                model_version=np.array(model_version),
+                signatures=np.array([entry[0] for _, entry in entries], dtype=np.uint32).reshape(-1, NUM_PERM),
+                categories=np.array([entry[1] for _, entry in entries], dtype=str),
+                confidences=np.array([np.nan if entry[2] is None else entry[2] for _, entry in entries], dtype=np.float64),
+                used_at=np.array([entry[3] for _, entry in entries], dtype=np.float64)
+            )
+        os.replace(tmp_path, self.path)
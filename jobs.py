@@ -0,0 +1,335 @@
+# jobs.py
+# Durable bulk classification jobs in a local SQLite queue
+# Emails are stored per job and claimed in batches by background workers that heartbeat,
+# so jobs interrupted by a restart resume from their unprocessed emails
+# Author: Dhanush
+# Date: April 19, 2025
+
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import asyncio
+import logging
+import threading
+from typing import Dict, Iterator, List, Optional
+from workers import inference_pool, PoolSaturated
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+JOBS_DB = os.environ.get("EMAIL_JOBS_DB", "jobs.db")
+JOB_WORKERS = int(os.environ.get("EMAIL_JOB_WORKERS", 2))
+JOB_BATCH_SIZE = int(os.environ.get("EMAIL_JOB_BATCH_SIZE", 256))
+# Seconds without a heartbeat before a worker's claimed batches are handed out again
+JOB_LEASE = float(os.environ.get("EMAIL_JOB_LEASE", 30))
+# Times a failing batch is tried before its emails get an error result
+JOB_MAX_ATTEMPTS = int(os.environ.get("EMAIL_JOB_MAX_ATTEMPTS", 3))
+JOB_POLL_INTERVAL = 1.0
+JOB_HEARTBEAT_INTERVAL = 5.0
+# Pause of a worker after a queue error (database locked, disk full)
+JOB_ERROR_BACKOFF = 5.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    processed INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    batch_size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    updated_at REAL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS job_items (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    email TEXT NOT NULL,
+    result TEXT,
+    claimed_by TEXT,
+    claimed_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS job_items_pending ON job_items (job_id, result);
+CREATE TABLE IF NOT EXISTS job_workers (
+    owner TEXT PRIMARY KEY,
+    heartbeat_at REAL NOT NULL
+);
+"""
+
+class JobQueue:
+    """SQLite-backed job store; safe to share between threads and preforked server processes."""
+
+    def __init__(self, path: str = JOBS_DB, lease: float = JOB_LEASE):
+        self.path = path
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        self.owner = None
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per process: preforked servers must not share the parent's
+        if self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            # Queues created before retries were counted
+            if "attempts" not in {row["name"] for row in conn.execute("PRAGMA table_info(job_items)")}:
+                conn.execute("ALTER TABLE job_items ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            self._connection, self._pid = conn, os.getpid()
+            # Unique per process, so a restarted server reusing a PID does not inherit claims
+            self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        return self._connection
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._connection.close()
+            self._connection = self._pid = None
+
+    def submit(self, emails: List[str], batch_size: int = JOB_BATCH_SIZE) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO jobs (id, status, total, batch_size, created_at) VALUES (?, 'queued', ?, ?, ?)",
+                    (job_id, len(emails), batch_size, now))
+                self._conn.executemany(
+                    "INSERT INTO job_items (job_id, idx, email) VALUES (?, ?, ?)",
+                    ((job_id, idx, email) for idx, email in enumerate(emails)))
+                if not emails:
+                    self._conn.execute("UPDATE jobs SET status = 'done', finished_at = ? WHERE id = ?", (now, job_id))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        logger.info(f"Queued job {job_id} with {len(emails)} emails")
+        return job_id
+
+    def claim(self) -> Optional[Dict]:
+        """Leases the next batch of unprocessed emails of the oldest active job, or returns None."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for job in self._conn.execute(
+                        "SELECT id, batch_size, started_at FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at").fetchall():
+                    rows = self._conn.execute(
+                        "SELECT idx, email FROM job_items WHERE job_id = ? AND result IS NULL AND (claimed_by IS NULL "
+                        "OR claimed_by NOT IN (SELECT owner FROM job_workers WHERE heartbeat_at >= ?)) ORDER BY idx LIMIT ?",
+                        (job["id"], now - self.lease, job["batch_size"])).fetchall()
+                    if not rows:
+                        continue
+                    indices = [row["idx"] for row in rows]
+                    self._conn.executemany(
+                        "UPDATE job_items SET claimed_by = ?, claimed_at = ? WHERE job_id = ? AND idx = ?",
+                        ((self.owner, now, job["id"], idx) for idx in indices))
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', started_at = COALESCE(started_at, ?) WHERE id = ?",
+                        (now, job["id"]))
+                    self._conn.execute("COMMIT")
+                    return {"job_id": job["id"], "batch_size": job["batch_size"], "indices": indices,
+                            "emails": [row["email"] for row in rows]}
+                self._conn.execute("COMMIT")
+                return None
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def release(self, batch: Dict):
+        """Hands a claimed batch back without waiting for its lease to expire."""
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE job_items SET claimed_by = NULL, claimed_at = NULL WHERE job_id = ? AND idx = ? AND result IS NULL",
+                ((batch["job_id"], idx) for idx in batch["indices"]))
+
+    def retry(self, batch: Dict, error: str, max_attempts: int = JOB_MAX_ATTEMPTS) -> int:
+        """Hands a failed batch back for another attempt; emails that have failed max_attempts
+        times get an error result instead. Returns how many failed for good."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "UPDATE job_items SET attempts = attempts + 1, claimed_by = NULL, claimed_at = NULL "
+                    "WHERE job_id = ? AND idx = ? AND result IS NULL",
+                    ((batch["job_id"], idx) for idx in batch["indices"]))
+                exhausted = {row["idx"] for idx in batch["indices"] for row in self._conn.execute(
+                    "SELECT idx FROM job_items WHERE job_id = ? AND idx = ? AND result IS NULL AND attempts >= ?",
+                    (batch["job_id"], idx, max_attempts))}
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if exhausted:
+            pairs = [(idx, email) for idx, email in zip(batch["indices"], batch["emails"]) if idx in exhausted]
+            self.complete({"job_id": batch["job_id"], "indices": [idx for idx, _ in pairs]},
+                          [{"input_email_body": email, "error": error} for _, email in pairs], failed=len(pairs))
+        return len(exhausted)
+
+    def heartbeat(self):
+        """Marks this process's claims as live; claims of owners silent for `lease` seconds are reclaimed."""
+        now = time.time()
+        with self._lock:
+            conn = self._conn
+            conn.execute("INSERT OR REPLACE INTO job_workers (owner, heartbeat_at) VALUES (?, ?)", (self.owner, now))
+            conn.execute("DELETE FROM job_workers WHERE heartbeat_at < ?", (now - 10 * self.lease,))
+
+    def complete(self, batch: Dict, results: List[Dict], failed: int = 0):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Only items still unanswered count, in case an expired lease let another worker finish them
+                stored = sum(self._conn.execute(
+                    "UPDATE job_items SET result = ?, claimed_by = NULL, claimed_at = NULL "
+                    "WHERE job_id = ? AND idx = ? AND result IS NULL",
+                    (json.dumps(result, ensure_ascii=False), batch["job_id"], idx)).rowcount
+                    for idx, result in zip(batch["indices"], results))
+                self._conn.execute(
+                    "UPDATE jobs SET processed = processed + ?, failed = failed + ?, updated_at = ? WHERE id = ?",
+                    (stored, min(failed, stored), now, batch["job_id"]))
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'done', finished_at = ? WHERE id = ? AND status = 'running' AND processed >= total",
+                    (now, batch["job_id"]))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def cancel(self, job_id: str) -> bool:
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status IN ('queued', 'running')",
+                (time.time(), job_id)).rowcount > 0
+
+    def status(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else _job_status(row)
+
+    def list(self, limit: int = 50) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        return [_job_status(row) for row in rows]
+
+    def results(self, job_id: str, chunk: int = 1000) -> Iterator[str]:
+        """Finished results of a job as JSON lines in submission order, read a chunk at a time."""
+        last = -1
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT idx, result FROM job_items WHERE job_id = ? AND idx > ? AND result IS NOT NULL ORDER BY idx LIMIT ?",
+                    (job_id, last, chunk)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield f'{{"index": {row["idx"]}, "result": {row["result"]}}}\n'
+            last = rows[-1]["idx"]
+
+def _job_status(row: sqlite3.Row) -> Dict:
+    status = dict(row)
+    end = row["finished_at"] or row["updated_at"]
+    elapsed = end - row["started_at"] if row["started_at"] and end else None
+    status["progress"] = row["processed"] / row["total"] if row["total"] else 1.0
+    status["emails_per_second"] = row["processed"] / elapsed if elapsed else None
+    remaining = row["total"] - row["processed"]
+    status["eta_seconds"] = remaining / status["emails_per_second"] if status["emails_per_second"] and row["status"] == "running" else None
+    return status
+
+class JobRunner:
+    """Background tasks on the server's event loop that feed queued batches to the inference pool."""
+
+    def __init__(self, queue: JobQueue, workers: int = JOB_WORKERS):
+        self.queue = queue
+        self.workers = workers
+        self._tasks = []
+        self._wake = None
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self.queue.heartbeat()
+        self._tasks = [asyncio.create_task(self._heartbeat())]
+        self._tasks += [asyncio.create_task(self._work(i)) for i in range(self.workers)]
+        logger.info(f"Started {self.workers} job workers on {self.queue.path}")
+
+    def notify(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+            try:
+                await asyncio.to_thread(self.queue.heartbeat)
+            except Exception as e:
+                logger.error(f"Job queue heartbeat failed: {e}")
+
+    async def _idle(self):
+        try:
+            await asyncio.wait_for(self._wake.wait(), JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        self._wake.clear()
+
+    async def _work(self, worker: int):
+        # An uncaught error would end this task silently, since nothing awaits it
+        while True:
+            batch = None
+            try:
+                if not inference_pool.ready:
+                    await self._idle()
+                    continue
+                batch = await asyncio.to_thread(self.queue.claim)
+                if batch is None:
+                    await self._idle()
+                    continue
+                await self._process(worker, batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job worker {worker} hit a queue error, retrying in {JOB_ERROR_BACKOFF}s: {e}")
+                if batch is not None:
+                    # Otherwise the batch stays claimed while this process keeps heartbeating
+                    try:
+                        await asyncio.to_thread(self.queue.release, batch)
+                    except Exception as release_error:
+                        logger.error(f"Job worker {worker} could not release its batch: {release_error}")
+                await asyncio.sleep(JOB_ERROR_BACKOFF)
+
+    async def _process(self, worker: int, batch: Dict):
+        try:
+            results = await inference_pool.classify_batch(batch["emails"], batch["batch_size"])
+        except PoolSaturated:
+            # Interactive requests have the pool; retry shortly
+            await asyncio.to_thread(self.queue.release, batch)
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            return
+        except asyncio.CancelledError:
+            await asyncio.to_thread(self.queue.release, batch)
+            raise
+        except Exception as e:
+            # Often transient (a pool restarting, a worker killed mid-batch): try the batch again
+            exhausted = await asyncio.to_thread(self.queue.retry, batch, str(e))
+            logger.error(f"Job worker {worker} failed a batch of job {batch['job_id']}: {e}; "
+                         f"{len(batch['indices']) - exhausted} emails queued for retry, "
+                         f"{exhausted} failed after {JOB_MAX_ATTEMPTS} attempts")
+            await asyncio.sleep(JOB_ERROR_BACKOFF)
+            return
+        await asyncio.to_thread(self.queue.complete, batch, results, 0)
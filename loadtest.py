@@ -0,0 +1,314 @@
+# loadtest.py
+# End-to-end load test of the FastAPI service over HTTP
+# Ramps concurrency against /classify or /classify/batch with synthetic or replayed emails and
+# records throughput, latency percentiles, error rate and server CPU/RSS per step as JSON
+# Author: Dhanush
+# Date: April 19, 2025
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+import threading
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import httpx
+from synthetic_emails import generate_emails
+from benchmark import latency_stats, git_commit
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+def load_emails(args) -> List[str]:
+    if args.replay:
+        emails = []
+        with open(args.replay) as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    emails.append(item["email"] if isinstance(item, dict) else item)
+        return emails
+    return [email["email"] for email in generate_emails(args.n, seed=args.seed, lines=args.lines, density=args.density)]
+
+def process_tree(pid: int) -> List[int]:
+    """pid and all its descendants (inference pool workers, preforked servers)."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+def server_usage(pid: int) -> Dict:
+    """CPU seconds and RSS bytes summed over the server's process tree."""
+    cpu_seconds, rss_bytes = 0.0, 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu_seconds += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+            with open(f"/proc/{member}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss_bytes += int(line.split()[1]) * 1024
+        except (OSError, IndexError, ValueError):
+            continue  # exited between listing and reading
+    return {"cpu_seconds": cpu_seconds, "rss_bytes": rss_bytes}
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class LocalServer:
+    """main.py started for the test: a subprocess on localhost, or uvicorn in a thread of this process."""
+
+    def __init__(self, in_process: bool, workers: int, log_path: str, port: Optional[int] = None, cache: bool = False):
+        self.in_process = in_process
+        self.workers = workers
+        self.cache = cache
+        self.log_path = log_path
+        self.port = port or free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.pid = None
+        self._process = None
+        self._server = None
+
+    def start(self, timeout: float):
+        env = {**os.environ, "EMAIL_LOG_REQUESTS": "0"}
+        if not self.cache:
+            # The corpus repeats across ramp steps; cached answers would measure the cache, not capacity
+            env["EMAIL_CACHE_ENTRIES"] = "0"
+        if self.in_process:
+            # CPU/RSS then include this load generator as well
+            os.environ.update(env)
+            import uvicorn
+            from main import app
+            self._server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning"))
+            threading.Thread(target=self._server.run, daemon=True).start()
+            self.pid = os.getpid()
+        else:
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+            # Server and access logs go to a file rather than interleaving with the report
+            with open(self.log_path, "w") as log:
+                self._process = subprocess.Popen(
+                    [sys.executable, script, "--host", "127.0.0.1", "--port", str(self.port), "--workers", str(self.workers)],
+                    env=env, stdout=log, stderr=subprocess.STDOUT)
+            self.pid = self._process.pid
+        wait_ready(self.url, timeout, self._process)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.should_exit = True
+        if self._process is not None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+
+def wait_ready(url: str, timeout: float, process: Optional[subprocess.Popen] = None):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode} before becoming ready")
+        try:
+            if httpx.get(f"{url}/readyz", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+def request_body(args, emails: List[str], i: int) -> tuple[str, Dict, int]:
+    if args.endpoint == "batch":
+        batch = [emails[(i + k) % len(emails)] for k in range(args.batch_size)]
+        return "/classify/batch", {"emails": batch, "depth": args.depth, "response": args.response}, len(batch)
+    return "/classify", {"email": emails[i % len(emails)], "depth": args.depth, "response": args.response}, 1
+
+async def run_step(args, url: str, emails: List[str], concurrency: int, duration: float) -> Dict:
+    latencies, statuses, counter = [], {}, [0]
+    emails_done = 0
+    stop_at = time.perf_counter() + duration
+
+    async def user(client: httpx.AsyncClient):
+        nonlocal emails_done
+        while time.perf_counter() < stop_at:
+            i = counter[0]
+            counter[0] += args.batch_size if args.endpoint == "batch" else 1
+            path, body, size = request_body(args, emails, i)
+            start = time.perf_counter()
+            try:
+                response = await client.post(path, json=body)
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == "200":
+                emails_done += size
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=args.timeout, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(user(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    requests = sum(statuses.values())
+    return {
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "requests": requests,
+        "requests_per_second": requests / elapsed,
+        "emails_per_second": emails_done / elapsed,
+        "error_rate": 1 - statuses.get("200", 0) / requests if requests else 0.0,
+        "statuses": statuses,
+        "latency": latency_stats(latencies)
+    }
+
+def find_knee(steps: List[Dict], min_gain: float = 0.1) -> Optional[int]:
+    """Concurrency after which more clients add less than min_gain throughput."""
+    for previous, step in zip(steps, steps[1:]):
+        if step["emails_per_second"] < previous["emails_per_second"] * (1 + min_gain):
+            return previous["concurrency"]
+    return None
+
+def compare_baseline(steps: List[Dict], params: Dict, baseline_path: str, tolerance: float) -> List[str]:
+    with open(baseline_path) as f:
+        report = json.load(f)
+    baseline = {step["concurrency"]: step for step in report["steps"]}
+    for key in ("endpoint", "batch_size", "depth", "response"):
+        if report["meta"]["params"].get(key) != params[key]:
+            logger.warning(f"Baseline {baseline_path} used {key}={report['meta']['params'].get(key)}, this run {params[key]}")
+    regressions = []
+    for step in steps:
+        before = baseline.get(step["concurrency"])
+        if before is None:
+            continue
+        if step["emails_per_second"] < before["emails_per_second"] * (1 - tolerance):
+            regressions.append(f"concurrency {step['concurrency']}: {step['emails_per_second']:.1f} emails/s vs {before['emails_per_second']:.1f}")
+        if step["latency"].get("p95_ms", 0) > before["latency"].get("p95_ms", 0) * (1 + tolerance):
+            regressions.append(f"concurrency {step['concurrency']}: p95 {step['latency']['p95_ms']:.1f} ms vs {before['latency']['p95_ms']:.1f}")
+    return regressions
+
+async def ramp(args, url: str, emails: List[str], pid: Optional[int]) -> List[Dict]:
+    steps = []
+    if args.warmup > 0:
+        await run_step(args, url, emails, args.concurrency[0], args.warmup)
+    for concurrency in args.concurrency:
+        before = server_usage(pid) if pid else None
+        step = await run_step(args, url, emails, concurrency, args.duration)
+        if pid:
+            after = server_usage(pid)
+            step["server_cpu_cores"] = (after["cpu_seconds"] - before["cpu_seconds"]) / step["seconds"]
+            step["server_rss_bytes"] = after["rss_bytes"]
+        steps.append(step)
+        logger.info(f"c={concurrency:<4} {step['emails_per_second']:8.1f} emails/s  p50 {step['latency'].get('p50_ms', 0):7.1f} ms  "
+                    f"p95 {step['latency'].get('p95_ms', 0):7.1f} ms  p99 {step['latency'].get('p99_ms', 0):7.1f} ms  "
+                    f"errors {step['error_rate']:.1%}"
+                    + (f"  cpu {step['server_cpu_cores']:.2f} cores  rss {step['server_rss_bytes'] / 1e6:.0f} MB" if pid else ""))
+    return steps
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the email classification API")
+    parser.add_argument("--url", help="test a running server instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="pid of the server at --url, for CPU/RSS")
+    parser.add_argument("--in-process", action="store_true", help="run the app in this process instead of a subprocess")
+    parser.add_argument("--workers", type=int, default=1, help="main.py --workers for a started server")
+    parser.add_argument("--cache", action="store_true", help="keep the result cache on in a started server (off by default)")
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    parser.add_argument("--endpoint", choices=["classify", "batch"], default="classify")
+    parser.add_argument("--batch-size", type=int, default=32, help="emails per /classify/batch request")
+    parser.add_argument("--depth", default="standard")
+    parser.add_argument("--response", default="full")
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32", help="comma-separated ramp of concurrent clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per ramp step")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of unrecorded load before the ramp")
+    parser.add_argument("--timeout", type=float, default=30, help="client timeout per request")
+    parser.add_argument("--replay", help="JSONL of emails (strings or {\"email\": ...}) instead of synthetic ones")
+    parser.add_argument("--n", type=int, default=2000, help="synthetic emails")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--lines", type=int, default=6)
+    parser.add_argument("--density", type=float, default=0.3)
+    parser.add_argument("--output-dir", default="bench_results")
+    parser.add_argument("--baseline", help="earlier loadtest JSON; exit 1 on regressions beyond --tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+    args.concurrency = [int(v) for v in args.concurrency.split(",")]
+
+    try:
+        emails = load_emails(args)
+    except Exception as e:
+        logger.error(f"Error loading emails: {e}")
+        exit(1)
+    if not emails:
+        logger.error("No emails to send")
+        exit(1)
+
+    server = None
+    url, pid = args.url, args.server_pid
+    if url is None:
+        os.makedirs(args.output_dir, exist_ok=True)
+        server = LocalServer(args.in_process, args.workers, os.path.join(args.output_dir, "loadtest_server.log"), cache=args.cache)
+        try:
+            server.start(args.startup_timeout)
+        except Exception as e:
+            logger.error(f"Error starting server: {e} (log: {server.log_path})")
+            server.stop()
+            exit(1)
+        url, pid = server.url, server.pid
+    logger.info(f"Load-testing {url}{'/classify/batch' if args.endpoint == 'batch' else '/classify'} with {len(emails)} emails")
+
+    try:
+        steps = asyncio.run(ramp(args, url, emails, pid))
+    finally:
+        if server is not None:
+            server.stop()
+
+    peak = max(steps, key=lambda step: step["emails_per_second"])
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "cpu_count": os.cpu_count(),
+            "target": "url" if args.url else ("in_process" if args.in_process else "subprocess"),
+            "params": {key: getattr(args, key) for key in ("endpoint", "batch_size", "depth", "response", "concurrency", "duration",
+                                                          "workers", "cache", "replay", "n", "seed", "lines", "density")}
+        },
+        "steps": steps,
+        "peak": {"concurrency": peak["concurrency"], "emails_per_second": peak["emails_per_second"]},
+        "knee_concurrency": find_knee(steps)
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = os.path.join(args.output_dir, f"loadtest_{report['meta']['commit']}_{datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Peak {peak['emails_per_second']:.1f} emails/s at concurrency {peak['concurrency']}, "
+                f"knee at {report['knee_concurrency']}. Saved {path}")
+
+    if args.baseline:
+        regressions = compare_baseline(steps, report["meta"]["params"], args.baseline, args.tolerance)
+        for regression in regressions:
+            logger.error(f"Regression: {regression}")
+        if regressions:
+            exit(1)
+
+if __name__ == "__main__":
+    main()
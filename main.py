@@ -3,29 +3,510 @@
 # Author: Dhanush
 # Date: April 19, 2025
 
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse, JSONResponse, ORJSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, ConfigDict, Field
+from contextlib import asynccontextmanager
+import os
+import hmac
+import signal
+import time
+import json
+import asyncio
 import logging
-from pipeline import mask_pii, classify_email, nlp, model
+from typing import List, Literal, Optional
+from utils import NER_BATCH_SIZE, LOG_REQUESTS, DEFAULT_MASK_DEPTH, DeadlineExceeded
+from metrics import REGISTRY as metrics
+from workers import inference_pool, PoolSaturated, ReloadInProgress
+from cache import ResultCache, CACHE_ENTRIES
+from jobs import JobQueue, JobRunner, JOB_BATCH_SIZE
+from responses import shape_result, DEFAULT_RESPONSE_MODE
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# Seconds a /classify or /classify/batch request may take, queueing included
+REQUEST_TIMEOUT = float(os.environ.get("EMAIL_REQUEST_TIMEOUT", 10))
+BATCH_TIMEOUT = float(os.environ.get("EMAIL_BATCH_TIMEOUT", 60))
+# Largest request body accepted; bulk job uploads have their own limit
+MAX_BODY_BYTES = int(os.environ.get("EMAIL_MAX_BODY_BYTES", 1024 * 1024))
+MAX_JOB_BYTES = int(os.environ.get("EMAIL_MAX_JOB_BYTES", 256 * 1024 * 1024))
+# Gzip responses of at least this many bytes for clients that accept it; 0 disables
+GZIP_MIN_BYTES = int(os.environ.get("EMAIL_GZIP_MIN_BYTES", 0))
+# Seconds between checks of the model files for a new version to hot-reload; 0 disables
+MODEL_WATCH_INTERVAL = float(os.environ.get("EMAIL_MODEL_WATCH_INTERVAL", 0))
+# Required in X-Admin-Token for /admin endpoints; unset disables them
+ADMIN_TOKEN = os.environ.get("EMAIL_ADMIN_TOKEN") or None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    inference_pool.start()
+    # Warm up in the background so /healthz answers while models load
+    warm_up = asyncio.create_task(inference_pool.warm_up())
+    job_runner.start()
+    # Preforked servers are reloaded by their parent, which also runs the file watch
+    watcher = None
+    if MODEL_WATCH_INTERVAL > 0 and preforked_parent is None:
+        watcher = asyncio.create_task(watch_models(MODEL_WATCH_INTERVAL))
+    yield
+    if watcher is not None:
+        watcher.cancel()
+    await job_runner.stop()
+    warm_up.cancel()
+    inference_pool.shutdown()
+
+def watched_stamp() -> tuple:
+    # Imported here so a server with worker processes does not load spaCy itself
+    from pipeline import model_stamp, MODEL_PATH, CASCADE_MODEL_PATH, SPACY_MODEL
+    config = inference_pool.model_config or {}
+    return model_stamp(config.get("model_path", MODEL_PATH), config.get("cascade_path", CASCADE_MODEL_PATH),
+                       config.get("spacy_model", SPACY_MODEL))
+
+async def watch_models(interval: float):
+    """Hot-reloads when the model files change, once they have looked the same for one more interval
+    (models.py writes them in place, so a changed stamp may be a file still being written)."""
+    serving = await asyncio.to_thread(watched_stamp)
+    reloaded_at, pending = inference_pool.reloaded_at, None
+    logger.info(f"Watching {[path for path, _, _ in serving]} for new model versions every {interval}s")
+    while True:
+        await asyncio.sleep(interval)
+        stamp = await asyncio.to_thread(watched_stamp)
+        if inference_pool.reloaded_at != reloaded_at:
+            # Reloaded through /admin/reload, possibly from other paths
+            serving, reloaded_at = stamp, inference_pool.reloaded_at
+        if stamp == serving or any(size is None for _, size, _ in stamp):
+            pending = None
+            continue
+        if stamp != pending or inference_pool.reloading:
+            pending = stamp
+            continue
+        logger.info("Model files changed, reloading")
+        try:
+            await inference_pool.reload()
+        except Exception:
+            pass  # logged by reload; retried only after the files change again
+        serving, reloaded_at, pending = stamp, inference_pool.reloaded_at, None
+
+job_queue = JobQueue()
+job_runner = JobRunner(job_queue)
+# PID of the serve_preforked parent in its forked servers; None for a single server
+preforked_parent = None
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+def payload_too_large(limit: int) -> dict:
+    return {"detail": {"error": "payload_too_large", "message": f"Request body exceeds {limit} bytes", "max_bytes": limit}}
+
+class BodySizeLimit:
+    """Answers 413 for bodies over the limit, from Content-Length up front or while a chunked body streams in."""
+
+    def __init__(self, app, max_bytes: int = MAX_BODY_BYTES, max_job_bytes: int = MAX_JOB_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.max_job_bytes = max_job_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        limit = self.max_job_bytes if scope["path"] == "/jobs" else self.max_bytes
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > limit:
+            return await JSONResponse(payload_too_large(limit), status_code=413)(scope, receive, send)
+
+        received = 0
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=payload_too_large(limit)["detail"])
+            return message
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(BodySizeLimit)
+if GZIP_MIN_BYTES > 0:
+    app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_BYTES)
+
+def deadline_exceeded(budget: float) -> HTTPException:
+    return HTTPException(status_code=504, detail={
+        "error": "deadline_exceeded",
+        "message": f"Request not finished within its {budget}s budget",
+        "budget_seconds": budget
+    })
+
+# Retries and automated notifications repeat bodies exactly; EMAIL_CACHE_ENTRIES=0 disables
+result_cache = ResultCache() if CACHE_ENTRIES > 0 else None
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    path = request.url.path
+    if path != "/metrics":
+        metrics.observe("email_request_seconds", time.perf_counter() - start, path=path)
+        metrics.inc("email_requests_total", path=path, status=response.status_code)
+    return response
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    gauges = {
+        "email_pool_in_flight": inference_pool.in_flight,
+        "email_pool_ready": int(inference_pool.ready),
+        "email_model_reloading": int(inference_pool.reloading),
+    }
+    if inference_pool.model_version is not None:
+        gauges["email_model_info"] = (1, {"version": inference_pool.model_version})
+    if inference_pool.reloaded_at is not None:
+        gauges["email_model_reloaded_timestamp_seconds"] = inference_pool.reloaded_at
+    if result_cache is not None:
+        stats = result_cache.stats()
+        # hits, misses, evictions and expirations are counters in the registry
+        for key in ("entries", "bytes"):
+            gauges[f"email_cache_{key}"] = stats[key]
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+# fast: regex only, no spaCy; standard: NER on unmasked lines; thorough: NER on every line
+MaskDepth = Literal["fast", "standard", "thorough"]
+# category: label only; spans: label plus entity offsets as parallel arrays; full: whole result
+ResponseMode = Literal["category", "spans", "full"]
 
 class EmailInput(BaseModel):
     email: str
+    depth: MaskDepth = DEFAULT_MASK_DEPTH
+    response: ResponseMode = DEFAULT_RESPONSE_MODE
+
+class EmailBatchInput(BaseModel):
+    emails: List[str]
+    batch_size: int = Field(NER_BATCH_SIZE, ge=1)
+    depth: MaskDepth = DEFAULT_MASK_DEPTH
+    response: ResponseMode = DEFAULT_RESPONSE_MODE
+
+def cache_version(depth: str, model_version: Optional[str] = None):
+    # Results differ by model and by masking depth; a result is stored under the
+    # version that produced it, which a reload may have changed meanwhile
+    version = model_version or inference_pool.model_version
+    return None if version is None else f"{version}/{depth}"
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    if inference_pool.ready:
+        return {"status": "ready"}
+    if inference_pool.error:
+        raise HTTPException(status_code=503, detail=f"Models not ready: {inference_pool.error}")
+    raise HTTPException(status_code=503, detail="Models warming up")
+
+@app.get("/cache/stats")
+async def cache_stats():
+    if result_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, "model_version": inference_pool.model_version, **result_cache.stats()}
 
 @app.post("/classify")
 async def classify_email_endpoint(email_input: EmailInput):
     try:
-        logger.info("Received email for classification")
-        result = classify_email(email_input.email)
-        return result
+        if LOG_REQUESTS:
+            logger.info("Received email for classification")
+        version = cache_version(email_input.depth)
+        if result_cache is not None and version is not None:
+            result = result_cache.get_result(email_input.email, version)
+            if result is not None:
+                return ORJSONResponse(shape_result(result, email_input.response))
+        # Workers check the deadline between stages, so they stop soon after the response is sent
+        deadline = time.time() + REQUEST_TIMEOUT
+        result = await asyncio.wait_for(inference_pool.classify(email_input.email, email_input.depth, deadline), REQUEST_TIMEOUT)
+        if result_cache is not None and version is not None:
+            result_cache.put_result(email_input.email, cache_version(email_input.depth, result["model_version"]), result)
+        # Serialized by orjson directly, skipping FastAPI's jsonable_encoder pass
+        return ORJSONResponse(shape_result(result, email_input.response))
+    except PoolSaturated as e:
+        logger.warning(f"Rejecting email, inference pool saturated: {e}")
+        raise HTTPException(status_code=503, detail="Server busy, retry later", headers={"Retry-After": "1"})
+    except (asyncio.TimeoutError, DeadlineExceeded):
+        logger.warning(f"Email of {len(email_input.email)} characters exceeded the {REQUEST_TIMEOUT}s budget")
+        raise deadline_exceeded(REQUEST_TIMEOUT)
     except Exception as e:
         logger.error(f"Error processing email: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-if __name__ == "__main__":
+@app.post("/classify/batch")
+async def classify_batch_endpoint(batch_input: EmailBatchInput):
+    try:
+        if LOG_REQUESTS:
+            logger.info(f"Received batch of {len(batch_input.emails)} emails for classification")
+        version = cache_version(batch_input.depth)
+        deadline = time.time() + BATCH_TIMEOUT
+        if result_cache is None or version is None:
+            results = await asyncio.wait_for(
+                inference_pool.classify_batch(batch_input.emails, batch_input.batch_size, batch_input.depth, deadline), BATCH_TIMEOUT)
+        else:
+            results = [result_cache.get_result(email, version) for email in batch_input.emails]
+            misses = [i for i, result in enumerate(results) if result is None]
+            if misses:
+                computed = await asyncio.wait_for(inference_pool.classify_batch(
+                    [batch_input.emails[i] for i in misses], batch_input.batch_size, batch_input.depth, deadline), BATCH_TIMEOUT)
+                for i, result in zip(misses, computed):
+                    result_cache.put_result(batch_input.emails[i], cache_version(batch_input.depth, result["model_version"]), result)
+                    results[i] = result
+        return ORJSONResponse([shape_result(result, batch_input.response) for result in results])
+    except PoolSaturated as e:
+        logger.warning(f"Rejecting batch, inference pool saturated: {e}")
+        raise HTTPException(status_code=503, detail="Server busy, retry later", headers={"Retry-After": "1"})
+    except (asyncio.TimeoutError, DeadlineExceeded):
+        logger.warning(f"Batch of {len(batch_input.emails)} emails exceeded the {BATCH_TIMEOUT}s budget")
+        raise deadline_exceeded(BATCH_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Error processing batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def require_admin(request: Request):
+    # A reload joblib-loads whatever path it is given, so there is no unauthenticated mode
+    if ADMIN_TOKEN is None:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set EMAIL_ADMIN_TOKEN to enable them")
+    if not hmac.compare_digest(request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+def model_status() -> dict:
+    return {
+        "model_version": inference_pool.model_version,
+        "model_config": inference_pool.model_config or {},
+        "ready": inference_pool.ready,
+        "reloading": inference_pool.reloading,
+        "reload_error": inference_pool.reload_error,
+        "reloaded_at": inference_pool.reloaded_at,
+        "watch_interval": MODEL_WATCH_INTERVAL
+    }
+
+class ReloadInput(BaseModel):
+    # Omitted fields keep their current setting; paths are read on the server
+    model_config = ConfigDict(protected_namespaces=())
+    model_path: Optional[str] = None
+    cascade_path: Optional[str] = None
+    cascade_threshold: Optional[float] = None
+    spacy_model: Optional[str] = None
+
+reload_task = None
+
+@app.get("/admin/model")
+async def model_info(request: Request):
+    require_admin(request)
+    return model_status()
+
+@app.post("/admin/reload", status_code=202)
+async def reload_models(request: Request, reload_input: Optional[ReloadInput] = None, wait: bool = False):
+    """Loads and warms the models from disk in the background, then switches to them.
+
+    Returns at once with 202 (poll /admin/model), or with wait=true once the
+    new version serves (200) or failed to load (500, old version still serving).
+    """
+    global reload_task
+    require_admin(request)
+    overrides = reload_input.model_dump() if reload_input is not None else {}
+    if preforked_parent is not None:
+        # This server is one of several; the parent reloads and re-forks all of them together
+        if wait or any(value is not None for value in overrides.values()):
+            raise HTTPException(status_code=409, detail=(
+                "With --workers, reloads re-fork every server from the configured model paths: "
+                "POST /admin/reload without a body or wait, or send SIGHUP to the parent process"))
+        os.kill(preforked_parent, signal.SIGHUP)
+        return {"status": "reloading", "preforked_parent": preforked_parent, **model_status()}
+    for key in ("model_path", "cascade_path"):
+        if overrides.get(key) is not None and not os.path.exists(overrides[key]):
+            raise HTTPException(status_code=400, detail=f"{key} {overrides[key]} does not exist")
+    if inference_pool.reloading or (reload_task is not None and not reload_task.done()):
+        raise HTTPException(status_code=409, detail="A model reload is already running")
+    reload_task = asyncio.create_task(inference_pool.reload(**overrides))
+    if not wait:
+        # Failures are logged and reported by /admin/model
+        reload_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return {"status": "reloading", **model_status(), "reloading": True, "status_url": "/admin/model"}
+    try:
+        await reload_task
+    except ReloadInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Model reload failed: {e}")
+    return ORJSONResponse({"status": "reloaded", **model_status()})
+
+def parse_job_emails(body: bytes, content_type: str) -> tuple[List[str], int]:
+    """Emails of a job submission: a JSON {"emails": [...], "batch_size": n} object, or
+    JSONL with one email string or {"email": ...} object per line."""
+    text = body.decode("utf-8")
+    if content_type.startswith("application/json"):
+        payload = json.loads(text)
+        if isinstance(payload, list):
+            return [_job_email(item) for item in payload], JOB_BATCH_SIZE
+        if not isinstance(payload, dict):
+            raise ValueError(f"Expected a JSON object or array, got {type(payload).__name__}")
+        # A string would otherwise be iterated as one email per character
+        if not isinstance(payload.get("emails"), list):
+            raise ValueError("emails must be a list")
+        return [_job_email(item) for item in payload["emails"]], int(payload.get("batch_size", JOB_BATCH_SIZE))
+    return [_job_email(json.loads(line)) for line in text.splitlines() if line.strip()], JOB_BATCH_SIZE
+
+def _job_email(item) -> str:
+    email = item.get("email") if isinstance(item, dict) else item
+    if not isinstance(email, str):
+        raise ValueError(f"Expected an email string or an object with an email field, got {type(item).__name__}")
+    return email
+
+@app.post("/jobs", status_code=202)
+async def submit_job(request: Request):
+    try:
+        emails, batch_size = parse_job_emails(await request.body(), request.headers.get("content-type", ""))
+    except (ValueError, KeyError, TypeError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid job submission: {e}")
+    if batch_size < 1:
+        raise HTTPException(status_code=400, detail="batch_size must be positive")
+    job_id = await asyncio.to_thread(job_queue.submit, emails, batch_size)
+    job_runner.notify()
+    return {"job_id": job_id, "total": len(emails), "status_url": f"/jobs/{job_id}", "results_url": f"/jobs/{job_id}/results"}
+
+@app.get("/jobs")
+async def list_jobs(limit: int = 50):
+    return await asyncio.to_thread(job_queue.list, limit)
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    status = await asyncio.to_thread(job_queue.status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return status
+
+@app.get("/jobs/{job_id}/results")
+async def job_results(job_id: str):
+    status = await asyncio.to_thread(job_queue.status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    # Streams whatever has finished so far; the header says whether more is coming
+    return StreamingResponse(job_queue.results(job_id), media_type="application/x-ndjson", headers={"X-Job-Status": status["status"]})
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    if not await asyncio.to_thread(job_queue.cancel, job_id):
+        raise HTTPException(status_code=404, detail="No queued or running job with this id")
+    return {"job_id": job_id, "status": "cancelled"}
+
+def serve_preforked(host: str, port: int, workers: int):
+    """Loads and warms the models once, then forks `workers` uvicorn servers on one socket.
+
+    Children share the parent's loaded pages copy-on-write, and a memory-mapped
+    artifact (EMAIL_MODEL_PATH pointing at an exported directory) keeps the
+    forest arrays in one shared page-cache copy. Each child runs inference in
+    its own threads instead of a process pool.
+
+    SIGHUP (sent by /admin/reload in any child, or by the file watch, which runs
+    here) loads and warms the models again in the parent and forks a new set of
+    servers from it; the old ones stop accepting and exit once their in-flight
+    requests finish. A failed load leaves the old servers running.
+    """
+    global preforked_parent
+    import socket
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    import pipeline
+
+    pipeline.model_holder.warm_up()
+    inference_pool.size = 0
+    preforked_parent = os.getpid()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    def fork_servers() -> List[int]:
+        pids = []
+        for _ in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+                    signal.signal(signum, signal.SIG_DFL)
+                uvicorn.Server(uvicorn.Config(app, log_level="info")).run(sockets=[sock])
+                os._exit(0)
+            pids.append(pid)
+        return pids
+
+    def terminate(pids: List[int]):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    state = {"stopping": False, "reload": False}
+    def stop(signum, frame):
+        state["stopping"] = True
+        terminate(children + draining)
+    def request_reload(signum, frame):
+        state["reload"] = True
+
+    children, draining = fork_servers(), []
+    logger.info(f"Serving on {host}:{port} with {workers} preforked workers: {children}")
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, request_reload)
+
+    serving = watched_stamp() if MODEL_WATCH_INTERVAL > 0 else None
+    pending, next_check = None, time.time() + MODEL_WATCH_INTERVAL
+    while children or draining:
+        time.sleep(0.2)
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if pid == 0:
+                break
+            children = [child for child in children if child != pid]
+            draining = [child for child in draining if child != pid]
+        if state["stopping"]:
+            continue
+        if serving is not None and time.time() >= next_check:
+            # Same rule as watch_models: reload once a change has settled for one interval
+            next_check = time.time() + MODEL_WATCH_INTERVAL
+            stamp = watched_stamp()
+            if stamp == serving or any(size is None for _, size, _ in stamp):
+                pending = None
+            elif stamp != pending:
+                pending = stamp
+            else:
+                logger.info("Model files changed, reloading")
+                serving, pending, state["reload"] = stamp, None, True
+        if state["reload"]:
+            state["reload"] = False
+            try:
+                holder = pipeline.ModelHolder()
+                holder.warm_up()
+            except Exception as e:
+                metrics.inc("email_model_reloads_total", result="failed")
+                logger.error(f"Model reload failed, servers keep {pipeline.model_holder.version}: {e}")
+                continue
+            previous = pipeline.model_holder.version
+            pipeline.install_models(holder)
+            # Inherited by the new servers
+            inference_pool.reloaded_at = time.time()
+            metrics.inc("email_model_reloads_total", result="ok")
+            old, children = children, fork_servers()
+            terminate(old)
+            draining += old
+            logger.info(f"Switched from model version {previous} to {holder.version}: servers {children}, draining {old}")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Email classification API")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="preforked server processes sharing preloaded models")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        serve_preforked(args.host, args.port, args.workers)
+    else:
+        import uvicorn
+        uvicorn.run(app, host=args.host, port=args.port)
@@ -1,14 +1,19 @@
 # mask_pii.py
 # Masks PII in emails.csv and saves to emails_masked.csv
 # Fixed phone regex, stricter name regex, prevents nested masking
+# Reads and writes the columnar store next to the CSVs as well (datastore.py)
 # Author: Dhanush
 # Date: April 19, 2025
 
 import spacy
-import pandas as pd
 import re
 from tqdm import tqdm
 import logging
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datastore import read_columns, iter_chunks, write_store, convert_csv, store_path
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -24,13 +29,10 @@ except Exception as e:
 
 # Define regex patterns
 phone_pattern = r'\b(?:\+?\d{1,4}[-.\s]?)?(?:\(\d{1,4}\)|[\d-]{1,4})?[-.\s]?\d{3,4}[-.\s]?\d{3,4}(?:[-.\s]?\d{3,4})?\b|\b\d{10,12}\b|<tel_num>'
-email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
+email_pattern = r'\b[A-Za-z0-9._%+-]{1,64}@[A-Za-z0-9.-]{1,253}\.[A-Z|a-z]{2,63}\b'  # bounded: linear scan
 name_pattern = r'\b[A-Z][a-z]{2,}\s[A-Z][a-z]{2,}\b'
 
-def mask_pii(text, nlp):
-    if not isinstance(text, str):
-        return text
-
+def _mask_regex(text):
     # Replace placeholders
     text = re.sub(r'<tel_num>', '[PHONE]', text)
     text = re.sub(r'<name>|<company_name>|<role>|<acc_num>', '[NAME]', text)
@@ -39,19 +41,138 @@ def mask_pii(text, nlp):
     text = re.sub(phone_pattern, '[PHONE]', text)
     text = re.sub(email_pattern, '[EMAIL]', text)
     text = re.sub(name_pattern, '[NAME]', text)
+    return text
 
+def _needs_ner(text):
     # Spacy NER only for unmasked text
-    if not re.search(r'\[PHONE\]|\[EMAIL\]|\[NAME\]', text):
-        doc = nlp(text)
-        for ent in doc.ents:
-            if ent.label_ == "PERSON" and not re.match(r'\[(PHONE|EMAIL|NAME)\]', ent.text):
-                text = text.replace(ent.text, "[NAME]")
+    return not re.search(r'\[PHONE\]|\[EMAIL\]|\[NAME\]', text)
+
+def _mask_ner(text, doc):
+    for ent in doc.ents:
+        if ent.label_ == "PERSON" and not re.match(r'\[(PHONE|EMAIL|NAME)\]', ent.text):
+            text = text.replace(ent.text, "[NAME]")
+    return text
+
+def mask_pii(text, nlp):
+    if not isinstance(text, str):
+        return text
 
+    text = _mask_regex(text)
+    if _needs_ner(text):
+        text = _mask_ner(text, nlp(text))
     return text
 
+def mask_texts(texts, nlp, batch_size=64):
+    """Same output as mask_pii on each text, with NER batched through nlp.pipe."""
+    masked = [_mask_regex(text) if isinstance(text, str) else text for text in texts]
+    pending = [i for i, text in enumerate(masked) if isinstance(text, str) and _needs_ner(text)]
+    docs = nlp.pipe((masked[i] for i in pending), batch_size=batch_size)
+    for i, doc in zip(pending, docs):
+        masked[i] = _mask_ner(masked[i], doc)
+    return masked
+
+def _mask_chunk(texts, batch_size):
+    # Runs in a worker process; the Spacy model is loaded once per worker at import
+    return mask_texts(texts, nlp, batch_size=batch_size)
+
+def _input_stamp(input_path):
+    # Size and mtime: a refreshed input must not resume after rows of the old one
+    stat = os.stat(input_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _load_checkpoint(path, input_path, output_path, chunksize):
+    if not os.path.exists(path):
+        return {"input": input_path, "input_stamp": _input_stamp(input_path), "chunksize": chunksize,
+                "chunks_done": 0, "rows_done": 0, "output_bytes": 0}
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("input") != input_path:
+        logger.error(f"Checkpoint {path} belongs to {checkpoint.get('input')}, not {input_path}")
+        exit(1)
+    if checkpoint.get("input_stamp") != _input_stamp(input_path):
+        logger.error(f"{input_path} changed since checkpoint {path} was written; delete the checkpoint to start over")
+        exit(1)
+    # chunks_done counts chunks of the recorded size; any other size would skip the wrong rows
+    if checkpoint.get("chunksize") != chunksize:
+        logger.error(f"Checkpoint {path} was written with --chunksize {checkpoint.get('chunksize')}, not {chunksize}")
+        exit(1)
+    output_size = os.path.getsize(output_path) if os.path.exists(output_path) else None
+    if checkpoint["output_bytes"] and (output_size is None or output_size < checkpoint["output_bytes"]):
+        logger.error(f"Checkpoint {path} expects {checkpoint['output_bytes']} bytes in {output_path}, found "
+                     f"{'no file' if output_size is None else output_size}; delete the checkpoint to start over")
+        exit(1)
+    return checkpoint
+
+def _save_checkpoint(path, checkpoint):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def mask_streaming(input_path, output_path, checkpoint_path, chunksize=2000, workers=None, batch_size=64):
+    """Masks input_path chunk by chunk in worker processes, appending to output_path.
+
+    After every chunk the output is flushed and the checkpoint records how many
+    chunks and output bytes are complete, so a restarted job truncates any
+    partial write and resumes with the next chunk. Resuming needs an unchanged
+    input (size and mtime), the same chunksize and an output file at least as
+    long as the checkpoint records. The checkpoint is removed once all chunks
+    are written. At most two chunks per worker are held in memory at once.
+    """
+    workers = workers or os.cpu_count() or 1
+
+    try:
+        checkpoint = _load_checkpoint(checkpoint_path, input_path, output_path, chunksize)
+        reader = iter_chunks(input_path, chunksize)
+    except Exception as e:
+        logger.error(f"Error loading dataset: {e}")
+        exit(1)
+    if checkpoint["chunks_done"]:
+        logger.info(f"Resuming after chunk {checkpoint['chunks_done']} ({checkpoint['rows_done']} rows done)")
+
+    mode = "r+b" if os.path.exists(output_path) else "wb"
+    with open(output_path, mode) as out, ProcessPoolExecutor(max_workers=workers) as executor, \
+            tqdm(initial=checkpoint["rows_done"], unit="rows") as progress:
+        out.truncate(checkpoint["output_bytes"])
+        out.seek(checkpoint["output_bytes"])
+        in_flight = []
+
+        def write_next():
+            chunk, future = in_flight.pop(0)
+            chunk["email_masked"] = future.result()
+            header = checkpoint["output_bytes"] == 0
+            out.write(chunk.to_csv(index=False, header=header).encode("utf-8"))
+            out.flush()
+            os.fsync(out.fileno())
+            checkpoint["chunks_done"] += 1
+            checkpoint["rows_done"] += len(chunk)
+            checkpoint["output_bytes"] = out.tell()
+            _save_checkpoint(checkpoint_path, checkpoint)
+            progress.update(len(chunk))
+
+        for idx, chunk in enumerate(reader):
+            if idx < checkpoint["chunks_done"]:
+                continue
+            in_flight.append((chunk, executor.submit(_mask_chunk, chunk["email"].tolist(), batch_size)))
+            if len(in_flight) >= 2 * workers:
+                write_next()
+        while in_flight:
+            write_next()
+
+    # A finished run leaves nothing to resume; the next run starts over
+    os.remove(checkpoint_path)
+    logger.info(f"Saved {checkpoint['rows_done']} rows to {output_path}")
+    try:
+        convert_csv(output_path)
+    except Exception as e:
+        logger.error(f"Error writing columnar store: {e}")
+        exit(1)
+
 def main():
     try:
-        df = pd.read_csv("emails.csv")
+        df = read_columns("emails.csv")
         logger.info(f"Dataset loaded successfully. Shape: {df.shape}")
     except Exception as e:
         logger.error(f"Error loading dataset: {e}")
@@ -63,7 +184,9 @@ def main():
 
     try:
         df.to_csv("emails_masked.csv", index=False)
-        logger.info("Saved emails_masked.csv")
+        # Written after the CSV so it counts as up to date
+        write_store([df], store_path("emails_masked.csv"))
+        logger.info("Saved emails_masked.csv and emails_masked.arrow")
     except Exception as e:
         logger.error(f"Error saving dataset: {e}")
         exit(1)
@@ -72,4 +195,18 @@ def main():
     print(df[["email", "type", "email_masked"]].head())
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Mask PII in emails.csv")
+    parser.add_argument("--stream", action="store_true", help="chunked, multi-process, resumable masking")
+    parser.add_argument("--input", default="emails.csv")
+    parser.add_argument("--output", default="emails_masked.csv")
+    parser.add_argument("--checkpoint", default=None, help="defaults to <output>.checkpoint.json")
+    parser.add_argument("--chunksize", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=None, help="defaults to CPU count")
+    parser.add_argument("--batch-size", type=int, default=64, help="nlp.pipe batch size")
+    args = parser.parse_args()
+
+    if args.stream:
+        mask_streaming(args.input, args.output, args.checkpoint or args.output + ".checkpoint.json",
+                       chunksize=args.chunksize, workers=args.workers, batch_size=args.batch_size)
+    else:
+        main()
\ No newline at end of file
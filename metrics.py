@@ -0,0 +1,134 @@
+# metrics.py
+# In-process latency histograms and counters, rendered in Prometheus text format
+# Author: Dhanush
+# Date: April 19, 2025
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# name -> (type, help, buckets)
+METRICS = {
+    "email_stage_seconds": ("histogram", "Latency of each masking and classification stage", LATENCY_BUCKETS),
+    "email_input_bytes": ("histogram", "Size of classified email bodies in characters", SIZE_BUCKETS),
+    "email_entities": ("histogram", "Masked entities per email", COUNT_BUCKETS),
+    "email_masked_entities_total": ("counter", "Masked entities by type", None),
+    "email_ner_lines_total": ("counter", "Candidate lines sent to spaCy NER", None),
+    "email_ner_skipped_total": ("counter", "Candidate lines the NER gate skipped", None),
+    "email_classified_total": ("counter", "Emails classified, by the cascade stage that answered", None),
+    "email_dedup_lookups_total": ("counter", "Near-duplicate index lookups by result (hit or miss)", None),
+    "email_dedup_evictions_total": ("counter", "Entries evicted from the near-duplicate index", None),
+    "email_cache_hits_total": ("counter", "Result cache lookups that found an entry", None),
+    "email_cache_misses_total": ("counter", "Result cache lookups that found no live entry", None),
+    "email_cache_evictions_total": ("counter", "Result cache entries evicted to stay within budget", None),
+    "email_cache_expirations_total": ("counter", "Result cache entries dropped after their TTL", None),
+    "email_request_seconds": ("histogram", "HTTP request latency", LATENCY_BUCKETS),
+    "email_requests_total": ("counter", "HTTP requests by path and status", None),
+    "email_pool_restarts_total": ("counter", "Inference pools replaced after a worker process died", None),
+    "email_model_reloads_total": ("counter", "Model hot reloads by result (ok or failed)", None),
+}
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}  # (name, sorted label items) -> _Histogram or float
+        self._local = threading.local()
+
+    def _record(self, kind: str, name: str, value: float, labels: Dict):
+        captured = getattr(self._local, "samples", None)
+        if captured is not None:
+            captured.append((kind, name, value, labels))
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if kind == "observe":
+                series = self._series.get(key)
+                if series is None:
+                    series = self._series[key] = _Histogram(METRICS[name][2])
+                series.observe(value)
+            else:
+                self._series[key] = self._series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        self._record("observe", name, value, labels)
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        self._record("inc", name, amount, labels)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("email_stage_seconds", time.perf_counter() - start, stage=name)
+
+    @contextmanager
+    def capture(self):
+        """Collects samples recorded by this thread instead of storing them, e.g. in a
+        worker process whose samples are replayed into the server's registry."""
+        self._local.samples = samples = []
+        try:
+            yield samples
+        finally:
+            self._local.samples = None
+
+    def replay(self, samples: List[tuple]):
+        for kind, name, value, labels in samples:
+            self._record(kind, name, value, labels)
+
+    def render(self, gauges: Optional[Dict[str, float]] = None) -> str:
+        with self._lock:
+            series = sorted(self._series.items(), key=lambda item: item[0])
+            snapshot = [(key, (list(s.counts), s.sum, s.count) if isinstance(s, _Histogram) else s) for key, s in series]
+
+        lines = []
+        described = set()
+        for (name, labels), value in snapshot:
+            kind, help_text, buckets = METRICS[name]
+            if name not in described:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+            if kind == "histogram":
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(list(buckets) + ["+Inf"], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {total}")
+                lines.append(f"{name}_count{_labels(labels)} {count}")
+            else:
+                lines.append(f"{name}{_labels(labels)} {value}")
+        for name, value in (gauges or {}).items():
+            # A (value, labels) pair renders a labelled gauge, e.g. an info metric
+            value, labels = value if isinstance(value, tuple) else (value, {})
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{_labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+REGISTRY = Registry()
@@ -5,20 +5,59 @@
 # Date: April 19, 2025
 
 import pandas as pd
+import numpy as np
 import logging
-from sklearn.model_selection import train_test_split
-from sklearn.feature_extraction.text import TfidfVectorizer
+import argparse
+import json
+import os
+import re
+import time
+from datetime import datetime, timezone
+import hashlib
+import pickle
+from sklearn.model_selection import train_test_split, StratifiedKFold
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import classification_report
+from sklearn.linear_model import SGDClassifier, LogisticRegression
+from sklearn.svm import LinearSVC
+from sklearn.metrics import classification_report, accuracy_score, f1_score
 from sklearn.pipeline import make_pipeline
+from scipy import sparse
 import joblib
+from datastore import read_columns
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def load_data(file_path):
+CLASSES = ["Change", "Incident", "Problem", "Request"]
+INCREMENTAL_MODEL_PATH = "incremental_model.pkl"
+ARTIFACT_DIR = "artifacts"
+FEATURE_CACHE_DIR = "feature_cache"
+
+# Search space for models.py --mode search
+VECTORIZER_GRID = [
+    {"max_features": 5000},
+    {"max_features": 5000, "sublinear_tf": True},
+    {"max_features": 20000, "ngram_range": [1, 2], "sublinear_tf": True},
+]
+MODEL_GRID = [
+    ("random_forest", {"n_estimators": 100}),
+    ("random_forest", {"n_estimators": 300, "min_samples_leaf": 2}),
+    ("random_forest", {"n_estimators": 100, "class_weight": "balanced"}),
+    ("logistic_regression", {"C": 4.0, "max_iter": 2000}),
+    ("logistic_regression", {"C": 4.0, "max_iter": 2000, "class_weight": "balanced"}),
+    ("linear_svc", {"C": 0.5}),
+]
+MODEL_TYPES = {
+    "random_forest": lambda params: RandomForestClassifier(random_state=42, **params),
+    "logistic_regression": lambda params: LogisticRegression(**params),
+    "linear_svc": lambda params: LinearSVC(**params),
+}
+
+def load_data(file_path, columns=("email_masked", "type")):
+    # Training only needs the masked text and the label; the columnar store reads just those
     try:
-        df = pd.read_csv(file_path)
+        df = read_columns(file_path, list(columns))
         logger.info(f"Dataset loaded successfully. Shape: {df.shape}")
         logger.info(f"Type counts:\n{df['type'].value_counts()}")
         return df
@@ -32,10 +71,12 @@ def train_model():
     y = df["type"]
 
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-    pipeline = make_pipeline(TfidfVectorizer(max_features=5000), RandomForestClassifier(n_estimators=100, random_state=42))
+    pipeline = make_pipeline(TfidfVectorizer(max_features=5000), RandomForestClassifier(n_estimators=100, random_state=42, n_jobs=-1))
     
     logger.info("Training Random Forest...")
     pipeline.fit(X_train, y_train)
+    # All cores for fitting; single-email predict is faster without joblib dispatch
+    pipeline[-1].set_params(n_jobs=None)
     
     logger.info("Evaluating Random Forest...")
     y_pred = pipeline.predict(X_test)
@@ -45,5 +86,391 @@ def train_model():
     joblib.dump(pipeline, "rf_model.pkl")
     logger.info("Model saved to rf_model.pkl")
 
+def _vectorizer(params):
+    # Grid entries are JSON-friendly; TfidfVectorizer wants a tuple ngram_range
+    params = dict(params)
+    if "ngram_range" in params:
+        params["ngram_range"] = tuple(params["ngram_range"])
+    return TfidfVectorizer(**params)
+
+def dataset_hash(df):
+    hashed = pd.util.hash_pandas_object(df[["email_masked", "type"]], index=False)
+    return hashlib.sha256(hashed.to_numpy().tobytes()).hexdigest()
+
+def cached_features(texts, data_hash, vectorizer_params, fit_idx=None, cache_dir=FEATURE_CACHE_DIR):
+    """TF-IDF matrix of all rows and fitted vectorizer for one dataset/config, cached as .npz + .pkl.
+
+    The vectorizer is fitted on the rows in fit_idx (a training fold) or on all
+    rows. The key is a hash of the dataset content, the vectorizer config and
+    fit_idx, so any change computes a fresh matrix and old entries are simply unused.
+    """
+    key_text = f"{data_hash}:{json.dumps(vectorizer_params, sort_keys=True)}"
+    if fit_idx is not None:
+        key_text += f":{hashlib.sha256(np.asarray(fit_idx, dtype=np.int64).tobytes()).hexdigest()}"
+    key = hashlib.sha256(key_text.encode()).hexdigest()[:16]
+    matrix_path = os.path.join(cache_dir, f"{key}.npz")
+    vectorizer_path = os.path.join(cache_dir, f"{key}_vectorizer.pkl")
+    if os.path.exists(matrix_path) and os.path.exists(vectorizer_path):
+        logger.info(f"Feature cache hit {key} for {vectorizer_params}")
+        return sparse.load_npz(matrix_path), joblib.load(vectorizer_path)
+
+    logger.info(f"Feature cache miss {key}, vectorizing with {vectorizer_params}")
+    vectorizer = _vectorizer(vectorizer_params)
+    if fit_idx is None:
+        X = vectorizer.fit_transform(texts)
+    else:
+        vectorizer.fit(texts.iloc[fit_idx])
+        X = vectorizer.transform(texts)
+    os.makedirs(cache_dir, exist_ok=True)
+    joblib.dump(vectorizer, vectorizer_path)
+    sparse.save_npz(matrix_path + ".tmp.npz", X.tocsr())
+    os.replace(matrix_path + ".tmp.npz", matrix_path)
+    return X.tocsr(), vectorizer
+
+def _evaluate_fold(X, y, model_name, model_params, train_idx, test_idx):
+    model = MODEL_TYPES[model_name](model_params)
+    start = time.perf_counter()
+    model.fit(X[train_idx], y[train_idx])
+    fit_seconds = time.perf_counter() - start
+
+    y_pred = model.predict(X[test_idx])
+    # Latency of the single-email path the API uses
+    rows = [X[i] for i in test_idx[:50]]
+    start = time.perf_counter()
+    for row in rows:
+        model.predict(row)
+    predict_ms = (time.perf_counter() - start) / max(len(rows), 1) * 1000
+
+    return {
+        "macro_f1": f1_score(y[test_idx], y_pred, average="macro"),
+        "accuracy": accuracy_score(y[test_idx], y_pred),
+        "fit_seconds": fit_seconds,
+        "predict_ms": predict_ms,
+        "model_bytes": len(pickle.dumps(model))
+    }
+
+def search_models(data_path="emails_masked.csv", folds=3, n_jobs=-1, report_path=None, save_best=None):
+    """Cross-validated search over VECTORIZER_GRID x MODEL_GRID, folds run in parallel.
+
+    The TF-IDF vectorizer is fitted on each training fold only, so the
+    vocabulary and idf weights never see the validation rows; the matrices
+    are cached per config and fold and shared by every model in MODEL_GRID.
+    """
+    df = load_data(data_path)
+    df = df.dropna(subset=["email_masked", "type"])
+    y = df["type"].to_numpy()
+    data_hash = dataset_hash(df)
+    splits = list(StratifiedKFold(n_splits=folds, shuffle=True, random_state=42).split(np.zeros(len(y)), y))
+
+    tasks = []
+    for v_idx, vectorizer_params in enumerate(VECTORIZER_GRID):
+        for train_idx, test_idx in splits:
+            X, _ = cached_features(df["email_masked"], data_hash, vectorizer_params, fit_idx=train_idx)
+            for m_idx, (model_name, model_params) in enumerate(MODEL_GRID):
+                tasks.append((v_idx, m_idx, joblib.delayed(_evaluate_fold)(X, y, model_name, model_params, train_idx, test_idx)))
+
+    logger.info(f"Running {len(tasks)} fits ({len(VECTORIZER_GRID)} vectorizers x {len(MODEL_GRID)} models x {folds} folds)")
+    fold_results = joblib.Parallel(n_jobs=n_jobs, verbose=5)(task for _, _, task in tasks)
+
+    candidates = {}
+    for (v_idx, m_idx, _), result in zip(tasks, fold_results):
+        candidates.setdefault((v_idx, m_idx), []).append(result)
+    results = []
+    for (v_idx, m_idx), folds_done in candidates.items():
+        model_name, model_params = MODEL_GRID[m_idx]
+        mean = lambda key: float(np.mean([fold[key] for fold in folds_done]))
+        results.append({
+            "vectorizer": VECTORIZER_GRID[v_idx],
+            "model": model_name,
+            "params": model_params,
+            "macro_f1": mean("macro_f1"),
+            "macro_f1_std": float(np.std([fold["macro_f1"] for fold in folds_done])),
+            "accuracy": mean("accuracy"),
+            "fit_seconds": mean("fit_seconds"),
+            "predict_ms": mean("predict_ms"),
+            "model_bytes": int(mean("model_bytes"))
+        })
+    results.sort(key=lambda result: result["macro_f1"], reverse=True)
+
+    logger.info(f"{'model':<20} {'vectorizer':<55} {'macro-F1':>8} {'fit s':>7} {'pred ms':>8} {'MB':>7}")
+    for result in results:
+        logger.info(f"{result['model']:<20} {json.dumps(result['vectorizer']):<55} {result['macro_f1']:>8.3f} "
+                    f"{result['fit_seconds']:>7.1f} {result['predict_ms']:>8.2f} {result['model_bytes'] / 1e6:>7.1f}")
+
+    report_path = report_path or os.path.join(ARTIFACT_DIR, "search_report.json")
+    os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+    with open(report_path, "w") as f:
+        json.dump({"data": data_path, "data_hash": data_hash, "folds": folds, "results": results}, f, indent=2)
+    logger.info(f"Search report saved to {report_path}")
+
+    if save_best:
+        best = results[0]
+        X, vectorizer = cached_features(df["email_masked"], data_hash, best["vectorizer"])
+        model = MODEL_TYPES[best["model"]](best["params"])
+        model.fit(X, y)
+        joblib.dump(make_pipeline(vectorizer, model), save_best)
+        logger.info(f"Best candidate ({best['model']}, macro-F1 {best['macro_f1']:.3f}) refitted on all rows and saved to {save_best}")
+    return results
+
+def _artifact_bytes(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+def export_forest(model_path="rf_model.pkl", output_path="rf_forest.npz", check_data="emails_masked.csv", check_rows=500):
+    """Flattens the Random Forest in model_path into contiguous arrays for pipeline.CompiledForest.
+
+    Writes output_path (feature, threshold, children and normalized leaf class
+    distributions of all trees, uncompressed) and the fitted vectorizer next to
+    it, then checks that the compiled predictor gives the same predictions as
+    the pickled pipeline on a sample of check_data. An output_path without the
+    .npz suffix is written as a directory of .npy files that the service opens
+    memory-mapped, so worker processes share the arrays.
+    """
+    from pipeline import CompiledModel
+
+    pipeline = joblib.load(model_path)
+    vectorizer, forest = pipeline[:-1], pipeline[-1]
+    if len(vectorizer) == 1:
+        vectorizer = vectorizer[0]
+    # stop_words_ keeps every term cut by max_features and is only for introspection
+    if hasattr(vectorizer, "stop_words_"):
+        del vectorizer.stop_words_
+
+    features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+    offset = 0
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        ids = np.arange(tree.node_count)
+        is_leaf = tree.children_left == -1
+        roots.append(offset)
+        features.append(np.where(is_leaf, 0, tree.feature).astype(np.int32))
+        thresholds.append(np.where(is_leaf, np.inf, tree.threshold))
+        lefts.append((np.where(is_leaf, ids, tree.children_left) + offset).astype(np.int32))
+        rights.append((np.where(is_leaf, ids, tree.children_right) + offset).astype(np.int32))
+        value = tree.value[:, 0, :]
+        totals = value.sum(axis=1, keepdims=True)
+        totals[totals == 0] = 1
+        values.append(value / totals)
+        offset += tree.node_count
+
+    arrays = dict(
+        feature=np.concatenate(features),
+        threshold=np.concatenate(thresholds),
+        left=np.concatenate(lefts),
+        right=np.concatenate(rights),
+        value=np.concatenate(values),
+        roots=np.array(roots, dtype=np.int32),
+        classes=np.asarray(forest.classes_).astype(str),
+        max_depth=np.array(max(estimator.tree_.max_depth for estimator in forest.estimators_)),
+        n_features=np.array(forest.n_features_in_)
+    )
+    if output_path.endswith(".npz"):
+        np.savez(output_path, **arrays)
+    else:
+        os.makedirs(output_path, exist_ok=True)
+        for key, array in arrays.items():
+            np.save(os.path.join(output_path, f"{key}.npy"), array)
+    joblib.dump(vectorizer, CompiledModel.vectorizer_path(output_path))
+    logger.info(f"Exported {len(roots)} trees ({offset} nodes) to {output_path}")
+
+    compiled = CompiledModel.load(output_path)
+    texts = load_data(check_data)["email_masked"].fillna("")
+    texts = texts.sample(n=min(check_rows, len(texts)), random_state=42).tolist()
+    expected = pipeline.predict(texts)
+    actual = compiled.predict(texts)
+    mismatches = int((expected != actual).sum())
+    if mismatches:
+        logger.error(f"Compiled forest disagrees with {model_path} on {mismatches} of {len(texts)} emails")
+        exit(1)
+
+    def per_call_ms(model):
+        start = time.perf_counter()
+        for text in texts[:100]:
+            model.predict([text])
+        return (time.perf_counter() - start) / len(texts[:100]) * 1000
+    logger.info(f"Predictions identical on {len(texts)} emails. Single-email predict: "
+                f"{per_call_ms(pipeline):.2f} ms pickled, {per_call_ms(compiled):.2f} ms compiled. "
+                f"Size: {_artifact_bytes(model_path) / 1e6:.1f} MB pickled, {_artifact_bytes(output_path) / 1e6:.1f} MB compiled")
+
+CASCADE_THRESHOLDS = [0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.99]
+
+def train_cascade(data_path="emails_masked.csv", model_path="rf_model.pkl", output_path="cascade_stage1.pkl", latency_rows=200):
+    """Trains the cascade's first stage and reports the accuracy/latency trade-off per threshold.
+
+    The forest in model_path is the second stage (trained with train_model if
+    missing). The first stage is a logistic regression on the forest's own
+    TF-IDF features, fitted on the same train split, so the service transforms
+    each email once for both stages.
+    """
+    if not os.path.exists(model_path):
+        logger.info(f"{model_path} not found, training the forest first")
+        train_model()
+    forest_pipeline = joblib.load(model_path)
+    vectorizer, forest = forest_pipeline[:-1], forest_pipeline[-1]
+
+    df = load_data(data_path)
+    X_train, X_test, y_train, y_test = train_test_split(df["email_masked"], df["type"], test_size=0.2, random_state=42)
+    features_train, features_test = vectorizer.transform(X_train), vectorizer.transform(X_test)
+    y_test = y_test.to_numpy()
+
+    logger.info("Training cascade first stage (logistic regression)...")
+    stage1 = LogisticRegression(C=4.0, max_iter=2000)
+    stage1.fit(features_train, y_train)
+    # The service refuses to pair this stage with a forest whose TF-IDF features differ
+    from pipeline import file_version, vectorizer_fingerprint
+    stage1.forest_version_ = file_version(model_path)
+    stage1.vectorizer_fingerprint_ = vectorizer_fingerprint(vectorizer)
+    joblib.dump(stage1, output_path)
+    logger.info(f"First stage saved to {output_path}")
+
+    stage1_proba = stage1.predict_proba(features_test)
+    stage1_pred = stage1.classes_.take(stage1_proba.argmax(axis=1))
+    stage1_conf = stage1_proba.max(axis=1)
+    forest_pred = forest.predict(features_test)
+
+    # Single-email latency of each stage, as the API calls them
+    rows = [features_test[i] for i in range(min(latency_rows, features_test.shape[0]))]
+    def per_call_ms(fn):
+        start = time.perf_counter()
+        for row in rows:
+            fn(row)
+        return (time.perf_counter() - start) / max(len(rows), 1) * 1000
+    stage1_ms, forest_ms = per_call_ms(stage1.predict_proba), per_call_ms(forest.predict_proba)
+
+    results = [{
+        "threshold": None,
+        "accuracy": accuracy_score(y_test, forest_pred),
+        "macro_f1": f1_score(y_test, forest_pred, average="macro"),
+        "stage1_share": 0.0,
+        "mean_predict_ms": forest_ms
+    }]
+    for threshold in CASCADE_THRESHOLDS:
+        confident = stage1_conf >= threshold
+        y_pred = np.where(confident, stage1_pred, forest_pred)
+        results.append({
+            "threshold": threshold,
+            "accuracy": accuracy_score(y_test, y_pred),
+            "macro_f1": f1_score(y_test, y_pred, average="macro"),
+            "stage1_share": float(confident.mean()),
+            "mean_predict_ms": stage1_ms + (1 - confident.mean()) * forest_ms
+        })
+
+    logger.info(f"{'threshold':>10} {'accuracy':>9} {'macro-F1':>9} {'stage-1 %':>10} {'ms/email':>9}")
+    for result in results:
+        label = "forest" if result["threshold"] is None else f"{result['threshold']:.2f}"
+        logger.info(f"{label:>10} {result['accuracy']:>9.3f} {result['macro_f1']:>9.3f} "
+                    f"{result['stage1_share'] * 100:>9.1f}% {result['mean_predict_ms']:>9.2f}")
+
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    report_path = os.path.join(ARTIFACT_DIR, "cascade_report.json")
+    with open(report_path, "w") as f:
+        json.dump({"stage1_ms": stage1_ms, "forest_ms": forest_ms, "results": results}, f, indent=2)
+    logger.info(f"Cascade report saved to {report_path}; serve with EMAIL_CASCADE_MODEL={output_path} EMAIL_CASCADE_THRESHOLD=<threshold>")
+    return results
+
+def build_incremental_pipeline():
+    # HashingVectorizer is stateless, so new rows never require refitting the featurizer
+    return make_pipeline(
+        HashingVectorizer(n_features=2 ** 20, alternate_sign=False, norm="l2"),
+        SGDClassifier(loss="log_loss", alpha=1e-5, random_state=42)
+    )
+
+def _next_version(artifact_dir):
+    versions = [int(m.group(1)) for name in os.listdir(artifact_dir)
+                if (m := re.match(r"incremental_v(\d+)\.pkl$", name))]
+    return max(versions, default=0) + 1
+
+def train_incremental(new_data_path, model_path=INCREMENTAL_MODEL_PATH, eval_data_path=None, holdout=0.1, epochs=1):
+    """Updates the incremental model with only the rows in new_data_path.
+
+    Loads model_path if it exists (otherwise starts a fresh model), runs
+    partial_fit over the new rows, evaluates on eval_data_path or a holdout of
+    the new rows, then overwrites model_path and writes a versioned copy plus a
+    JSON report to artifacts/.
+    """
+    df = load_data(new_data_path)
+    unknown = ~df["type"].isin(CLASSES)
+    if unknown.any():
+        logger.warning(f"Dropping {unknown.sum()} rows with labels outside {CLASSES}")
+        df = df[~unknown]
+
+    if eval_data_path:
+        train_df, eval_df = df, load_data(eval_data_path)
+    else:
+        train_df, eval_df = train_test_split(df, test_size=holdout, random_state=42)
+
+    if os.path.exists(model_path):
+        pipeline = joblib.load(model_path)
+        logger.info(f"Updating existing model {model_path}")
+    else:
+        pipeline = build_incremental_pipeline()
+        logger.info(f"No model at {model_path}, starting a new one")
+    vectorizer, classifier = pipeline[0], pipeline[-1]
+
+    start = time.perf_counter()
+    X_train = vectorizer.transform(train_df["email_masked"].fillna(""))
+    y_train = train_df["type"].to_numpy()
+    for epoch in range(epochs):
+        order = np.random.default_rng(epoch).permutation(len(train_df))
+        classifier.partial_fit(X_train[order], y_train[order], classes=CLASSES)
+    fit_seconds = time.perf_counter() - start
+    logger.info(f"partial_fit on {len(train_df)} rows took {fit_seconds:.2f}s")
+
+    y_pred = pipeline.predict(eval_df["email_masked"].fillna(""))
+    report = classification_report(eval_df["type"], y_pred, zero_division=0)
+    logger.info(f"Classification Report:\n{report}")
+
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    version = _next_version(ARTIFACT_DIR)
+    artifact_path = os.path.join(ARTIFACT_DIR, f"incremental_v{version:04d}.pkl")
+    tmp_path = model_path + ".tmp"
+    joblib.dump(pipeline, tmp_path)
+    os.replace(tmp_path, model_path)
+    joblib.dump(pipeline, artifact_path)
+
+    evaluation = {
+        "version": version,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "new_data": new_data_path,
+        "train_rows": len(train_df),
+        "eval_rows": len(eval_df),
+        "epochs": epochs,
+        "fit_seconds": fit_seconds,
+        "accuracy": accuracy_score(eval_df["type"], y_pred),
+        "macro_f1": f1_score(eval_df["type"], y_pred, average="macro", zero_division=0),
+        "report": classification_report(eval_df["type"], y_pred, zero_division=0, output_dict=True)
+    }
+    with open(os.path.join(ARTIFACT_DIR, f"incremental_v{version:04d}_report.json"), "w") as f:
+        json.dump(evaluation, f, indent=2)
+    logger.info(f"Model saved to {model_path} and {artifact_path}")
+    return evaluation
+
 if __name__ == "__main__":
-    train_model()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Train the email type classifier")
+    parser.add_argument("--mode", choices=["full", "incremental", "search", "export", "cascade"], default="full")
+    parser.add_argument("--new-data", help="masked CSV with only the newly labelled rows (incremental mode)")
+    parser.add_argument("--eval-data", help="masked CSV to evaluate on; defaults to a holdout of --new-data")
+    parser.add_argument("--model-path", default=INCREMENTAL_MODEL_PATH)
+    parser.add_argument("--holdout", type=float, default=0.1)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--data", default="emails_masked.csv", help="masked CSV to search over (search mode)")
+    parser.add_argument("--folds", type=int, default=3)
+    parser.add_argument("--n-jobs", type=int, default=-1, help="parallel fits in search mode (-1 = all cores)")
+    parser.add_argument("--save-best", help="refit the best search candidate on all rows and save it here")
+    parser.add_argument("--rf-model", default="rf_model.pkl", help="pickled pipeline to export (export mode)")
+    parser.add_argument("--output", default="rf_forest.npz", help="compiled forest: file.npz, or a directory for the memory-mapped format (export mode)")
+    args = parser.parse_args()
+
+    if args.mode == "incremental":
+        if not args.new_data:
+            parser.error("--new-data is required in incremental mode")
+        train_incremental(args.new_data, args.model_path, args.eval_data, args.holdout, args.epochs)
+    elif args.mode == "cascade":
+        train_cascade(args.data, args.rf_model)
+    elif args.mode == "export":
+        export_forest(args.rf_model, args.output, check_data=args.data)
+    elif args.mode == "search":
+        search_models(args.data, folds=args.folds, n_jobs=args.n_jobs, save_best=args.save_best)
+    else:
+        train_model()
\ No newline at end of file
@@ -3,135 +3,468 @@
 # Author: Dhanush
 # Date: April 19, 2025
 
+import os
+import hashlib
+import importlib.util
 import spacy
-import re
 import joblib
+import numpy as np
 import logging
-from typing import List, Dict
+import threading
+import multiprocessing.util
+from typing import List, Dict, Optional
+from utils import mask_pii, mask_pii_batch, check_deadline, NER_BATCH_SIZE, LOG_REQUESTS, DEFAULT_MASK_DEPTH
+from metrics import REGISTRY as metrics
+from dedup import DedupIndex, signature, DEDUP_ENTRIES
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-try:
-    nlp = spacy.load("en_core_web_sm", disable=["parser", "tagger", "lemmatizer"])
-    logger.info("Spacy model loaded successfully")
-except Exception as e:
-    logger.error(f"Error loading Spacy model: {e}")
-    exit(1)
-
-try:
-    model = joblib.load("rf_model.pkl")
-    logger.info("Random Forest model loaded successfully")
-except Exception as e:
-    logger.error(f"Error loading model: {e}")
-    exit(1)
-
-# Regex patterns for PII (strict to avoid overlaps)
-phone_pattern = r'\b(?:\+?\d{1,4}[-.\s]?)?(?:\(\d{3}\))?[-.\s]?\d{3}[-.\s]?\d{4}\b'
-email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-name_pattern = r'\b[A-Z][a-z]{2,}\s[A-Z][a-z]{2,}\b'
-dob_pattern = r'\b(?:0[1-9]|1[0-2])[-/](?:0[1-9]|[12][0-9]|3[01])[-/](?:19|20)\d{2}\b'
-aadhar_pattern = r'\b\d{4}\s\d{4}\s\d{4}\b'
-credit_debit_pattern = r'\b\d{4}[- ]\d{4}[- ]\d{4}[- ]\d{4}\b'
-cvv_pattern = r'(?<!\d)\b\d{3}\b(?!\d)'  # 3 digits, not part of larger number
-expiry_pattern = r'\b(?:0[1-9]|1[0-2])/\d{2}\b'
-placeholder_pattern = r'\b(?:<name>|<company_name>|<role>|<acc_num>|\[Ihr Name\])\b'
-
-def mask_pii(text: str, nlp) -> tuple[str, List[Dict]]:
-    if not isinstance(text, str):
-        return text, []
-
-    masked_entities = []
-    
-    def add_entity(start: int, end: int, entity_type: str, entity_value: str):
-        masked_entities.append({
-            "position": [start, end],
-            "classification": entity_type,
-            "entity": entity_value
-        })
-
-    # Initialize masked text
-    masked_text = text
-    offset = 0
-
-    # Apply regex patterns in order of specificity
-    patterns = [
-        (email_pattern, '[email]', 'email'),
-        (aadhar_pattern, '[aadhar_num]', 'aadhar_num'),
-        (credit_debit_pattern, '[credit_debit_no]', 'credit_debit_no'),
-        (dob_pattern, '[dob]', 'dob'),
-        (phone_pattern, '[phone_number]', 'phone_number'),
-        (expiry_pattern, '[expiry_no]', 'expiry_no'),
-        (cvv_pattern, '[cvv_no]', 'cvv_no'),
-        (placeholder_pattern, '[full_name]', 'full_name'),
-    ]
+SPACY_MODEL = os.environ.get("EMAIL_SPACY_MODEL", "en_core_web_sm")
+MODEL_PATH = os.environ.get("EMAIL_MODEL_PATH", "rf_model.pkl")
+# Optional cheap first stage (models.py --mode cascade); emails it is less sure of fall through to the forest
+CASCADE_MODEL_PATH = os.environ.get("EMAIL_CASCADE_MODEL") or None
+CASCADE_THRESHOLD = float(os.environ.get("EMAIL_CASCADE_THRESHOLD", 0.9))
+WARMUP_EMAIL = "Subject: Warm-up\nHello, my name is John Doe, contact me at john.doe@example.com or 555-123-4567."
+
+class ModelLoadError(Exception):
+    pass
+
+def file_version(path: str) -> str:
+    """Short content hash of a model file (or every file of an artifact directory), used as its version."""
+    digest = hashlib.sha256()
+    paths = [os.path.join(path, name) for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+    for file_path in paths:
+        digest.update(os.path.basename(file_path).encode())
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()[:12]
+
+def vectorizer_fingerprint(vectorizer) -> str:
+    """Short hash of a fitted TF-IDF vocabulary and idf weights (a vectorizer or a pipeline of them)."""
+    digest = hashlib.sha256()
+    for step in ([step for _, step in vectorizer.steps] if hasattr(vectorizer, "steps") else [vectorizer]):
+        vocabulary = getattr(step, "vocabulary_", None)
+        if vocabulary is not None:
+            digest.update(repr(sorted((term, int(index)) for term, index in vocabulary.items())).encode("utf-8", "surrogatepass"))
+        idf = getattr(step, "idf_", None)
+        if idf is not None:
+            digest.update(np.asarray(idf, dtype=np.float64).tobytes())
+    return digest.hexdigest()[:12]
+
+def check_cascade(cascade, model, model_path: str):
+    """Refuses a first stage trained on another forest's TF-IDF features.
+
+    models.py --mode cascade records the forest's file_version and vectorizer
+    fingerprint in the artifact. The fingerprint is what has to match: an
+    exported copy of the same forest (other files, same vectorizer) is fine,
+    while a retrained forest with a new vocabulary would silently feed the
+    first stage the wrong columns.
+    """
+    expected = getattr(cascade, "vectorizer_fingerprint_", None)
+    if expected is None:
+        raise ModelLoadError("Cascade model does not record the forest it was trained for; retrain it with python models.py --mode cascade")
+    vectorizer, _ = _split_model(model)
+    actual = None if vectorizer is None else vectorizer_fingerprint(vectorizer)
+    if actual != expected:
+        raise ModelLoadError(
+            f"Cascade model was trained for forest {getattr(cascade, 'forest_version_', '?')} (TF-IDF {expected}), "
+            f"but {model_path} has TF-IDF {actual}; retrain it with python models.py --mode cascade")
+
+def spacy_meta_path(spacy_model: str) -> Optional[str]:
+    """meta.json of a spaCy model given as a directory or installed package; None for blank:xx pipelines."""
+    path = spacy_model
+    if not os.path.isdir(path):
+        # Located without importing it, so the watcher does not load the package
+        spec = None if spacy_model.startswith("blank:") else importlib.util.find_spec(spacy_model)
+        if spec is None or not spec.submodule_search_locations:
+            return None
+        path = list(spec.submodule_search_locations)[0]
+    meta_path = os.path.join(path, "meta.json")
+    return meta_path if os.path.exists(meta_path) else None
+
+def spacy_version(spacy_model: str) -> str:
+    """Short hash of a spaCy model's name or path and its meta.json (name, version, training results)."""
+    digest = hashlib.sha256(spacy_model.encode("utf-8", "surrogatepass"))
+    meta_path = spacy_meta_path(spacy_model)
+    if meta_path is not None:
+        with open(meta_path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+def model_files(model_path: str = MODEL_PATH, cascade_path: Optional[str] = CASCADE_MODEL_PATH,
+                spacy_model: str = SPACY_MODEL) -> List[str]:
+    """Every file a ModelHolder with these paths reads, with the spaCy model represented by its meta.json."""
+    paths = [model_path]
+    if os.path.isdir(model_path):
+        paths = [os.path.join(model_path, name) for name in sorted(os.listdir(model_path))]
+    elif model_path.endswith(".npz"):
+        paths.append(CompiledModel.vectorizer_path(model_path))
+    if cascade_path is not None:
+        paths.append(cascade_path)
+    meta_path = spacy_meta_path(spacy_model)
+    if meta_path is not None:
+        paths.append(meta_path)
+    return paths
+
+def model_stamp(model_path: str = MODEL_PATH, cascade_path: Optional[str] = CASCADE_MODEL_PATH,
+                spacy_model: str = SPACY_MODEL) -> tuple:
+    """(path, size, mtime) of each model file: a cheap change check that does not hash the files."""
+    stamp = []
+    for path in model_files(model_path, cascade_path, spacy_model):
+        try:
+            stat = os.stat(path)
+            stamp.append((path, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            stamp.append((path, None, None))
+    return tuple(stamp)
+
+# Rows per CompiledForest.predict_proba step: 1024 x 5000 float32 features is 20 MB
+PREDICT_CHUNK_ROWS = 1024
+
+class CompiledForest:
+    """Random Forest flattened into contiguous arrays by models.export_forest.
+
+    All trees are walked in lockstep with NumPy: node ids are global indices into
+    feature/threshold/left/right, and leaves point to themselves with an infinite
+    threshold, so max_depth steps always end on a leaf. Feature values are cast
+    to float32 and class distributions summed tree by tree, as scikit-learn does,
+    so predictions match RandomForestClassifier.predict.
+    """
+
+    def __init__(self, arrays):
+        self.feature = arrays["feature"]
+        self.threshold = arrays["threshold"]
+        self.left = arrays["left"]
+        self.right = arrays["right"]
+        self.value = arrays["value"]
+        self.roots = arrays["roots"]
+        self.classes_ = arrays["classes"]
+        self.max_depth = int(arrays["max_depth"])
+        self.n_features = int(arrays["n_features"])
+
+    ARRAYS = ("feature", "threshold", "left", "right", "value", "roots", "classes", "max_depth", "n_features")
+
+    @classmethod
+    def load(cls, path: str):
+        if os.path.isdir(path):
+            # Uncompressed .npy files mapped read-only: every process on the host
+            # shares one page-cache copy of the trees instead of a private one
+            return cls({key: np.load(os.path.join(path, f"{key}.npy"), mmap_mode="r") for key in cls.ARRAYS})
+        with np.load(path, allow_pickle=False) as arrays:
+            return cls({key: arrays[key] for key in arrays.files})
+
+    def predict_proba(self, X):
+        # Rows go through in fixed-size chunks, so the dense features and node ids stay
+        # a few MB however large the batch (250k short emails would need GBs at once)
+        X = X.tocsr()
+        proba = np.empty((X.shape[0], self.value.shape[1]))
+        for start in range(0, X.shape[0], PREDICT_CHUNK_ROWS):
+            proba[start:start + PREDICT_CHUNK_ROWS] = self._predict_proba_chunk(X[start:start + PREDICT_CHUNK_ROWS])
+        return proba
+
+    def _predict_proba_chunk(self, X):
+        n_rows = X.shape[0]
+        dense = np.zeros((n_rows, self.n_features), dtype=np.float32)
+        dense[np.repeat(np.arange(n_rows), np.diff(X.indptr)), X.indices] = X.data
+
+        rows = np.arange(n_rows)[:, None]
+        nodes = np.broadcast_to(self.roots, (n_rows, len(self.roots))).copy()
+        for depth in range(self.max_depth):
+            go_left = dense[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+            # Most paths are far shorter than the deepest tree
+            if depth % 8 == 7 and (self.left[nodes] == nodes).all():
+                break
+
+        proba = np.zeros((X.shape[0], self.value.shape[1]))
+        for tree in range(len(self.roots)):
+            proba += self.value[nodes[:, tree]]
+        return proba / len(self.roots)
+
+    def predict(self, X):
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1))
+
+class CompiledModel:
+    """TF-IDF vectorizer plus CompiledForest; drop-in for the rf_model.pkl pipeline's predict."""
+
+    def __init__(self, vectorizer, forest: CompiledForest):
+        self.vectorizer = vectorizer
+        self.forest = forest
+        self.classes_ = forest.classes_
+
+    @staticmethod
+    def vectorizer_path(path: str) -> str:
+        if os.path.isdir(path) or not path.endswith(".npz"):
+            return os.path.join(path, "vectorizer.pkl")
+        return path[:-len(".npz")] + "_vectorizer.pkl"
+
+    @classmethod
+    def load(cls, path: str):
+        return cls(joblib.load(cls.vectorizer_path(path)), CompiledForest.load(path))
+
+    def predict(self, texts: List[str]):
+        return self.forest.predict(self.vectorizer.transform(texts))
 
-    for pattern, placeholder, entity_type in patterns:
-        matches = list(re.finditer(pattern, masked_text))
-        replacements = []
-        for match in matches:
-            start, end = match.start(), match.end()
-            entity_value = match.group()
-            replacements.append((start, end, placeholder, entity_value))
-            add_entity(start, end, entity_type, entity_value)
-        # Apply replacements in reverse order to preserve positions
-        replacements.sort(key=lambda x: x[0], reverse=True)
-        for start, end, placeholder, _ in replacements:
-            masked_text = masked_text[:start] + placeholder + masked_text[end:]
-
-    # Apply name pattern, skip subjects
-    matches = list(re.finditer(name_pattern, masked_text))
-    replacements = []
-    for match in matches:
-        start, end = match.start(), match.end()
-        entity_value = match.group()
-        # Skip if in subject line or already masked
-        if (not re.match(r'^Subject:.*$', masked_text[:start].split('\n')[-1]) and
-            not re.search(r'\[(full_name|email|phone_number|dob|aadhar_num|credit_debit_no|cvv_no|expiry_no)\]', entity_value)):
-            replacements.append((start, end, '[full_name]', entity_value))
-            add_entity(start, end, 'full_name', entity_value)
-    replacements.sort(key=lambda x: x[0], reverse=True)
-    for start, end, placeholder, _ in replacements:
-        masked_text = masked_text[:start] + placeholder + masked_text[end:]
-
-    # Apply Spacy NER for names not caught by regex
-    lines = masked_text.split('\n')
-    masked_lines = []
-    offset = 0
-    for line in lines:
-        original_line = line
-        if not re.search(r'\[(full_name|email|phone_number|dob|aadhar_num|credit_debit_no|cvv_no|expiry_no)\]', line):
-            doc = nlp(line)
-            replacements = []
-            for ent in doc.ents:
-                if (ent.label_ == "PERSON" and len(ent.text.split()) >= 2 and
-                    not re.match(r'^Subject:.*$', line) and
-                    not re.match(r'\[(full_name|email|phone_number|dob|aadhar_num|credit_debit_no|cvv_no|expiry_no)\]', ent.text)):
-                    start, end = ent.start_char, ent.end_char
-                    replacements.append((start, end, '[full_name]', ent.text))
-                    add_entity(offset + start, offset + end, 'full_name', ent.text)
-            replacements.sort(key=lambda x: x[0], reverse=True)
-            for start, end, placeholder, _ in replacements:
-                line = line[:start] + placeholder + line[end:]
-        masked_lines.append(line)
-        offset += len(original_line) + 1
-
-    masked_text = '\n'.join(masked_lines)
-    return masked_text, masked_entities
-
-def classify_email(email: str) -> Dict:
-    logger.info("Masking email...")
-    masked_email, masked_entities = mask_pii(email, nlp)
-    
-    logger.info("Classifying email...")
-    prediction = model.predict([masked_email])[0]
-    
-    return {
+def load_model(path: str):
+    # .npz file or memory-mapped directory: a forest exported by models.py --mode export;
+    # anything else a joblib pipeline
+    if path.endswith(".npz") or os.path.isdir(path):
+        return CompiledModel.load(path)
+    return joblib.load(path)
+
+class ModelHolder:
+    """Loads the Spacy model and the classifier on first use, once, from any thread."""
+
+    def __init__(self, spacy_model: str = SPACY_MODEL, model_path: str = MODEL_PATH,
+                 cascade_path: Optional[str] = CASCADE_MODEL_PATH, cascade_threshold: float = CASCADE_THRESHOLD):
+        self.spacy_model = spacy_model
+        self.model_path = model_path
+        self.cascade_path = cascade_path
+        self.cascade_threshold = cascade_threshold
+        self._lock = threading.Lock()
+        self._nlp = None
+        self._model = None
+        self._cascade = None
+        self._version = None
+        self._nlp_version = None
+        self.ready = False
+
+    @property
+    def nlp(self):
+        if self._nlp is None:
+            with self._lock:
+                if self._nlp is None:
+                    try:
+                        self._nlp_version = spacy_version(self.spacy_model)
+                        self._nlp = spacy.load(self.spacy_model, disable=["parser", "tagger", "lemmatizer"])
+                        logger.info("Spacy model loaded successfully")
+                    except Exception as e:
+                        logger.error(f"Error loading Spacy model {self.spacy_model}: {e}")
+                        raise ModelLoadError(f"Could not load Spacy model {self.spacy_model}") from e
+        return self._nlp
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    try:
+                        self._version = file_version(self.model_path)
+                        self._model = load_model(self.model_path)
+                        logger.info("Random Forest model loaded successfully")
+                    except Exception as e:
+                        logger.error(f"Error loading model {self.model_path}: {e}")
+                        raise ModelLoadError(f"Could not load model {self.model_path}") from e
+        return self._model
+
+    @property
+    def cascade(self):
+        if self.cascade_path is None:
+            return None
+        if self._cascade is None:
+            # Loaded first: the pairing check needs its vectorizer, and both take the lock
+            model = self.model
+            with self._lock:
+                if self._cascade is None:
+                    try:
+                        cascade = joblib.load(self.cascade_path)
+                        cascade_version = file_version(self.cascade_path)
+                    except Exception as e:
+                        logger.error(f"Error loading cascade model {self.cascade_path}: {e}")
+                        raise ModelLoadError(f"Could not load cascade model {self.cascade_path}") from e
+                    try:
+                        check_cascade(cascade, model, self.model_path)
+                    except ModelLoadError as e:
+                        logger.error(f"Error loading cascade model {self.cascade_path}: {e}")
+                        raise
+                    self._cascade, self._cascade_version = cascade, cascade_version
+                    logger.info(f"Cascade first stage loaded, threshold {self.cascade_threshold}")
+        return self._cascade
+
+    @property
+    def version(self) -> str:
+        # Content hash of the model file(s) that were actually loaded, then of the spaCy model:
+        # masking changes with it, so cached results must too
+        self.model  # loads the model on first use, which records the version
+        if self._nlp_version is None:
+            self._nlp_version = spacy_version(self.spacy_model)
+        if self.cascade is None:
+            return f"{self._version}~{self._nlp_version}"
+        return f"{self._version}+{self._cascade_version}@{self.cascade_threshold}~{self._nlp_version}"
+
+    def warm_up(self):
+        # Runs a dummy email through both stages so the first real request pays no load or cache cost
+        masked_email, _ = mask_pii(WARMUP_EMAIL, self.nlp)
+        predict(self.model, [masked_email], self.cascade, self.cascade_threshold)
+        # A holder warmed for a reload binds the index when install_models switches to it
+        if dedup_index is not None and self is model_holder:
+            dedup_index.use_version(self.version)
+        self.ready = True
+        logger.info("Models warmed up")
+
+model_holder = ModelHolder()
+
+# Reuses categories of near-identical masked emails; EMAIL_DEDUP_ENTRIES=0 (default) disables
+dedup_index = DedupIndex() if DEDUP_ENTRIES > 0 else None
+if dedup_index is not None and dedup_index.path is not None:
+    # Finalizers also run when multiprocessing workers exit, which skip atexit handlers
+    multiprocessing.util.Finalize(dedup_index, dedup_index.sync, exitpriority=10)
+
+def install_models(holder: ModelHolder):
+    """Switches new requests to a warmed holder; requests already running finish on the one they started with."""
+    global model_holder
+    model_holder = holder
+    if dedup_index is not None:
+        dedup_index.use_version(holder.version)
+    logger.info(f"Serving model version {holder.version}")
+
+def __getattr__(name):
+    # pipeline.nlp / pipeline.model still work, but load lazily
+    if name == "nlp":
+        return model_holder.nlp
+    if name == "model":
+        return model_holder.model
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def _split_model(model):
+    """(vectorizer, classifier) of a pipeline or compiled model; (None, model) otherwise."""
+    if isinstance(model, CompiledModel):
+        return model.vectorizer, model.forest
+    if hasattr(model, "steps"):
+        return model[:-1], model[-1]
+    return None, model
+
+def predict(model, texts: List[str], cascade=None, threshold: float = CASCADE_THRESHOLD) -> tuple[list, list, list]:
+    """Category, confidence and answering stage per text.
+
+    Confidence is the top-class predict_proba (None for models without it).
+    With a cascade first stage, texts it scores at or above threshold are
+    answered by it ("linear"); only the rest pay for the forest. Both stages
+    share one TF-IDF transform.
+    """
+    vectorizer, classifier = _split_model(model)
+    if vectorizer is None:
+        with metrics.stage("predict"):
+            return list(model.predict(texts)), [None] * len(texts), ["model"] * len(texts)
+    with metrics.stage("tfidf"):
+        features = vectorizer.transform(texts)
+
+    labels, confidences, stages = [None] * len(texts), [None] * len(texts), ["forest"] * len(texts)
+    remaining = np.arange(len(texts))
+    if cascade is not None:
+        with metrics.stage("linear"):
+            proba = cascade.predict_proba(features)
+        best, top = proba.argmax(axis=1), proba.max(axis=1)
+        for i in np.flatnonzero(top >= threshold):
+            labels[i], confidences[i], stages[i] = cascade.classes_[best[i]], float(top[i]), "linear"
+        remaining = np.flatnonzero(top < threshold)
+
+    if len(remaining):
+        with metrics.stage("forest"):
+            if hasattr(classifier, "predict_proba"):
+                # argmax of predict_proba is exactly what RandomForestClassifier.predict returns
+                proba = classifier.predict_proba(features[remaining])
+                predicted = classifier.classes_.take(proba.argmax(axis=1))
+                top = proba.max(axis=1)
+            else:
+                predicted, top = classifier.predict(features[remaining]), [None] * len(remaining)
+        for i, label, confidence in zip(remaining, predicted, top):
+            labels[i], confidences[i] = label, None if confidence is None else float(confidence)
+    for stage in stages:
+        metrics.inc("email_classified_total", stage=stage)
+    return labels, confidences, stages
+
+def classify_masked(masked_emails: List[str], holder: Optional[ModelHolder] = None) -> tuple[list, list, list]:
+    """predict() with the holder's models, answering near-duplicates of indexed emails from the index ("dedup")."""
+    holder = holder or model_holder
+    # The index holds the serving version only; requests finishing on a replaced holder skip it
+    if dedup_index is None or holder is not model_holder:
+        return predict(holder.model, masked_emails, holder.cascade, holder.cascade_threshold)
+    dedup_index.use_version(holder.version)
+    with metrics.stage("dedup"):
+        signatures = [signature(masked_email) for masked_email in masked_emails]
+        matches = [dedup_index.lookup(sig) for sig in signatures]
+
+    labels, confidences, stages = [None] * len(masked_emails), [None] * len(masked_emails), ["dedup"] * len(masked_emails)
+    misses = []
+    for i, match in enumerate(matches):
+        if match is None:
+            misses.append(i)
+        else:
+            labels[i], confidences[i], _ = match
+            metrics.inc("email_classified_total", stage="dedup")
+    if misses:
+        predicted = predict(holder.model, [masked_emails[i] for i in misses], holder.cascade, holder.cascade_threshold)
+        for i, label, confidence, stage in zip(misses, *predicted):
+            labels[i], confidences[i], stages[i] = label, confidence, stage
+            dedup_index.add(signatures[i], str(label), confidence)
+    return labels, confidences, stages
+
+def _record_email(email: str, masked_entities: List[Dict]):
+    metrics.observe("email_input_bytes", len(email) if isinstance(email, str) else 0)
+    metrics.observe("email_entities", len(masked_entities))
+    for entity in masked_entities:
+        metrics.inc("email_masked_entities_total", type=entity["classification"])
+
+def _nlp_for(depth: str, holder: ModelHolder):
+    # The regex-only tier never touches spaCy, so it need not be loaded
+    return None if depth == "fast" else holder.nlp
+
+def classify_email(email: str, depth: str = DEFAULT_MASK_DEPTH, deadline: Optional[float] = None) -> Dict:
+    """Masks and classifies one email; raises utils.DeadlineExceeded once time.time() passes deadline."""
+    # One holder for the whole email, even if a reload switches models meanwhile
+    holder = model_holder
+    if LOG_REQUESTS:
+        logger.info("Masking email...")
+    masked_email, masked_entities = mask_pii(email, _nlp_for(depth, holder), depth=depth, deadline=deadline)
+    _record_email(email, masked_entities)
+    check_deadline(deadline)
+
+    if LOG_REQUESTS:
+        logger.info("Classifying email...")
+    labels, confidences, stages = classify_masked([masked_email], holder)
+
+    result = {
         "input_email_body": email,
         "list_of_masked_entities": masked_entities,
         "masked_email": masked_email,
-        "category_of_the_email": prediction
+        "category_of_the_email": labels[0],
+        "confidence": confidences[0],
+        "classified_by": stages[0],
+        "model_version": holder.version
     }
+    return result
+
+def classify_emails(emails: List[str], batch_size: int = NER_BATCH_SIZE, depth: str = DEFAULT_MASK_DEPTH,
+                    deadline: Optional[float] = None) -> List[Dict]:
+    holder = model_holder
+    if LOG_REQUESTS:
+        logger.info(f"Masking {len(emails)} emails...")
+    masked = mask_pii_batch(emails, _nlp_for(depth, holder), batch_size=batch_size, depth=depth, deadline=deadline)
+    for email, (_, masked_entities) in zip(emails, masked):
+        _record_email(email, masked_entities)
+
+    if LOG_REQUESTS:
+        logger.info(f"Classifying {len(emails)} emails...")
+    if not emails:
+        return []
+    check_deadline(deadline)
+    labels, confidences, stages = classify_masked([masked_email for masked_email, _ in masked], holder)
+
+    return [
+        {
+            "input_email_body": email,
+            "list_of_masked_entities": masked_entities,
+            "masked_email": masked_email,
+            "category_of_the_email": label,
+            "confidence": confidence,
+            "classified_by": stage,
+            "model_version": holder.version
+        }
+        for email, (masked_email, masked_entities), label, confidence, stage in zip(emails, masked, labels, confidences, stages)
+    ]
 
 if __name__ == "__main__":
     test_email = """
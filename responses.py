@@ -0,0 +1,31 @@
+# responses.py
+# Response shapes for classification results, serialized with orjson
+# Author: Dhanush
+# Date: April 19, 2025
+
+import os
+from typing import Dict, List
+
+# category: label only; spans: label plus entity offsets as parallel arrays; full: everything classify_email returns
+RESPONSE_MODES = ("category", "spans", "full")
+DEFAULT_RESPONSE_MODE = os.environ.get("EMAIL_RESPONSE_MODE", "full")
+CATEGORY_FIELDS = ("category_of_the_email", "confidence", "classified_by", "model_version")
+
+def compact_entities(entities: List[Dict]) -> Dict[str, list]:
+    """Entity dicts as parallel start / end / classification arrays of offsets into the submitted email."""
+    return {
+        "start": [entity["position"][0] for entity in entities],
+        "end": [entity["position"][1] for entity in entities],
+        "classification": [entity["classification"] for entity in entities]
+    }
+
+def shape_result(result: Dict, mode: str = DEFAULT_RESPONSE_MODE) -> Dict:
+    if mode == "full":
+        return result
+    if mode not in RESPONSE_MODES:
+        raise ValueError(f"Unknown response mode {mode!r}, expected one of {RESPONSE_MODES}")
+    # The caller already has the email, so neither mode echoes it, the masked text or entity text
+    shaped = {field: result[field] for field in CATEGORY_FIELDS}
+    if mode == "spans":
+        shaped["entities"] = compact_entities(result["list_of_masked_entities"])
+    return shaped
@@ -1,18 +1,19 @@
 # spot_check_pii.py
 # Spot-checks PII masking for specific rows
 # Aligned regex, fixed phone detection
+# Reads only the checked rows from the columnar store (datastore.py)
 # Author: Dhanush
 # Date: April 19, 2025
 
-import pandas as pd
 import re
 import logging
+from datastore import read_rows
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 phone_pattern = r'\b(?:\+?\d{1,4}[-.\s]?)?(?:\(\d{1,4}\)|[\d-]{1,4})?[-.\s]?\d{3,4}[-.\s]?\d{3,4}(?:[-.\s]?\d{3,4})?\b|\b\d{10,12}\b|<tel_num>'
-email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
+email_pattern = r'\b[A-Za-z0-9._%+-]{1,64}@[A-Za-z0-9.-]{1,253}\.[A-Z|a-z]{2,63}\b'  # bounded: linear scan
 name_pattern = r'\b[A-Z][a-z]{2,}\s[A-Z][a-z]{2,}\b'
 
 def validate_pii(text, row_idx):
@@ -43,14 +44,14 @@ def validate_pii(text, row_idx):
     return issues
 
 def main():
+    rows_to_check = [5, 64, 23778, 23818]
     try:
-        df = pd.read_csv("emails_masked.csv")
+        df = read_rows("emails_masked.csv", rows_to_check, ["email_masked"])
         logger.info("Spot-checking PII masking for specific rows")
     except Exception as e:
         logger.error(f"Error loading dataset: {e}")
         exit(1)
 
-    rows_to_check = [5, 64, 23778, 23818]
     issues = []
     for idx in rows_to_check:
         if idx in df.index:
@@ -0,0 +1,101 @@
+# synthetic_emails.py
+# Seeded generator of support emails with injected PII, for benchmarks
+# Covers every entity type pipeline.py masks, at a controlled density and body length
+# Author: Dhanush
+# Date: April 19, 2025
+
+import json
+import random
+import argparse
+from typing import List, Dict
+
+FIRST_NAMES = ["John", "Maria", "Elena", "Rahul", "Priya", "Lukas", "Sofia", "Ahmed", "Chen", "Olivia"]
+LAST_NAMES = ["Smith", "Garcia", "Ivanova", "Sharma", "Patel", "Schneider", "Rossi", "Hassan", "Wang", "Brown"]
+DOMAINS = ["example.com", "mail.org", "company.co.in", "support.net"]
+PLACEHOLDERS = ["<name>", "<company_name>", "<role>", "<acc_num>"]
+CATEGORIES = ["Incident", "Request", "Problem", "Change"]
+
+FILLER = [
+    "Our billing dashboard has been failing to load since this morning.",
+    "Could you please update the access rights for the analytics workspace?",
+    "The data export keeps timing out when we select more than one month.",
+    "We would like to schedule the server migration for next weekend.",
+    "Several users report that the mobile app crashes on login.",
+    "Please confirm whether the new pricing applies to existing contracts.",
+    "the integration stopped syncing records after the last update.",
+    "Thank you for the quick response to our previous request.",
+    "We noticed intermittent latency on the payment gateway.",
+    "kindly share the steps to reset two factor authentication.",
+]
+SUBJECTS = ["Account Access", "Billing Issue", "Server Migration", "Data Export", "Login Failure", "Urgent Request"]
+
+def _entity(rng: random.Random, entity_type: str) -> str:
+    digits = lambda n: ''.join(rng.choice('0123456789') for _ in range(n))
+    if entity_type == "email":
+        return f"{rng.choice(FIRST_NAMES).lower()}.{rng.choice(LAST_NAMES).lower()}@{rng.choice(DOMAINS)}"
+    if entity_type == "aadhar_num":
+        return f"{digits(4)} {digits(4)} {digits(4)}"
+    if entity_type == "credit_debit_no":
+        sep = rng.choice(["-", " "])
+        return sep.join(digits(4) for _ in range(4))
+    if entity_type == "cvv_no":
+        return digits(3)
+    if entity_type == "expiry_no":
+        return f"{rng.randint(1, 12):02d}/{rng.randint(24, 35)}"
+    if entity_type == "dob":
+        return f"{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/{rng.randint(1950, 2005)}"
+    if entity_type == "phone_number":
+        return rng.choice([f"+91 {digits(3)} {digits(3)} {digits(4)}", f"({digits(3)}) {digits(3)}-{digits(4)}", f"{digits(3)}-{digits(3)}-{digits(4)}"])
+    if entity_type == "full_name":
+        return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+    if entity_type == "placeholder":
+        return rng.choice(PLACEHOLDERS)
+    raise ValueError(f"Unknown entity type {entity_type}")
+
+ENTITY_TEMPLATES = {
+    "email": "You can reach me at {}.",
+    "aadhar_num": "My Aadhar number is {}.",
+    "credit_debit_no": "The card used was {}.",
+    "cvv_no": "CVV: {}",
+    "expiry_no": "It expires on {}.",
+    "dob": "My date of birth is {}.",
+    "phone_number": "Please call me on {}.",
+    "full_name": "I am writing on behalf of {}.",
+    "placeholder": "Regards, {}",
+}
+ENTITY_TYPES = list(ENTITY_TEMPLATES)
+
+def generate_email(rng: random.Random, lines: int = 6, density: float = 0.3) -> Dict:
+    """One email of `lines` body lines; each line carries an entity with probability `density`."""
+    body = [f"Subject: {rng.choice(SUBJECTS)}", f"Dear {rng.choice(['Support Team', 'Customer Support'])},"]
+    entities = []
+    for _ in range(lines):
+        line = rng.choice(FILLER)
+        if rng.random() < density:
+            entity_type = rng.choice(ENTITY_TYPES)
+            value = _entity(rng, entity_type)
+            line = f"{line} {ENTITY_TEMPLATES[entity_type].format(value)}"
+            entities.append({"classification": entity_type, "entity": value})
+        body.append(line)
+    signature = _entity(rng, "full_name")
+    body.append(f"Best regards,\n{signature}")
+    entities.append({"classification": "full_name", "entity": signature})
+    return {"email": '\n'.join(body), "type": rng.choice(CATEGORIES), "entities": entities}
+
+def generate_emails(n: int, seed: int = 42, lines: int = 6, density: float = 0.3) -> List[Dict]:
+    rng = random.Random(seed)
+    return [generate_email(rng, lines=lines, density=density) for _ in range(n)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic PII email corpus as JSONL")
+    parser.add_argument("--n", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--lines", type=int, default=6, help="body lines per email")
+    parser.add_argument("--density", type=float, default=0.3, help="probability a line carries PII")
+    parser.add_argument("--output", default="synthetic_emails.jsonl")
+    args = parser.parse_args()
+
+    with open(args.output, "w") as f:
+        for email in generate_emails(args.n, seed=args.seed, lines=args.lines, density=args.density):
+            f.write(json.dumps(email) + "\n")
+    print(f"Wrote {args.n} emails to {args.output}")
@@ -1,14 +1,21 @@
 # utils.py
 # Utility functions for PII masking
+# Single-pass masking engine: one compiled scan, offsets against the original text
 # Author: Dhanush
 # Date: April 19, 2025
 
-import spacy
+import os
 import re
-from typing import List, Dict
+import time
+import bisect
+import threading
+from typing import List, Dict, Optional
+from metrics import REGISTRY as metrics
 
 phone_pattern = r'\b(?:\+?\d{1,4}[-.\s]?)?(?:\(\d{3}\))?[-.\s]?\d{3}[-.\s]?\d{4}\b'
-email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
+# Quantifiers are bounded (RFC 5321 lengths) so every scan position costs constant time:
+# unbounded runs made the scan quadratic on long runs like 'a.a.a.' or '1234-1234-'
+email_pattern = r'\b[A-Za-z0-9._%+-]{1,64}@[A-Za-z0-9.-]{1,253}\.[A-Z|a-z]{2,63}\b'
 name_pattern = r'\b[A-Z][a-z]{2,}\s[A-Z][a-z]{2,}\b'
 dob_pattern = r'\b(?:0[1-9]|1[0-2])[-/](?:0[1-9]|[12][0-9]|3[01])[-/](?:19|20)\d{2}\b'
 aadhar_pattern = r'\b\d{4}\s\d{4}\s\d{4}\b'
@@ -17,84 +24,246 @@ cvv_pattern = r'(?<!\d)\b\d{3}\b(?!\d)'  # 3 digits, not part of larger number
 expiry_pattern = r'\b(?:0[1-9]|1[0-2])/\d{2}\b'
 placeholder_pattern = r'\b(?:<name>|<company_name>|<role>|<acc_num>|\[Ihr Name\])\b'
 
-def mask_pii(text: str, nlp) -> tuple[str, List[Dict]]:
-    if not isinstance(text, str):
-        return text, []
+# Entity types in priority order: (group name, pattern, classification, placeholder).
+# All types are matched in a single scan; when several match at the same
+# position the earliest entry in this list wins.
+PII_PATTERNS = [
+    ('email', email_pattern, 'email', '[email]'),
+    ('aadhar_num', aadhar_pattern, 'aadhar_num', '[aadhar_num]'),
+    ('credit_debit_no', credit_debit_pattern, 'credit_debit_no', '[credit_debit_no]'),
+    ('dob', dob_pattern, 'dob', '[dob]'),
+    ('phone_number', phone_pattern, 'phone_number', '[phone_number]'),
+    ('expiry_no', expiry_pattern, 'expiry_no', '[expiry_no]'),
+    ('cvv_no', cvv_pattern, 'cvv_no', '[cvv_no]'),
+    ('placeholder', placeholder_pattern, 'full_name', '[full_name]'),
+    ('full_name', name_pattern, 'full_name', '[full_name]'),
+]
+PII_REGEX = re.compile('|'.join(f'(?P<{group}>{pattern})' for group, pattern, _, _ in PII_PATTERNS))
+PII_TYPES = {group: (classification, placeholder) for group, _, classification, placeholder in PII_PATTERNS}
+MASK_TOKEN_REGEX = re.compile(r'\[(full_name|email|phone_number|dob|aadhar_num|credit_debit_no|cvv_no|expiry_no)\]')
+
+# Number of lines spaCy processes per nlp.pipe batch in mask_pii_batch
+NER_BATCH_SIZE = 256
+# Skip spaCy on lines that cannot hold a multi-token PERSON (EMAIL_NER_GATE=0 sends every line)
+NER_GATE = os.environ.get("EMAIL_NER_GATE", "1") != "0"
+# Masking depth: "fast" is regex only (no spaCy), "standard" runs NER on gated lines
+# without a mask token, "thorough" runs NER on every line and merges non-overlapping names
+MASK_DEPTHS = ("fast", "standard", "thorough")
+DEFAULT_MASK_DEPTH = os.environ.get("EMAIL_MASK_DEPTH", "standard")
+# Per-request INFO logging on the hot path (EMAIL_LOG_REQUESTS=0 turns it off)
+LOG_REQUESTS = os.environ.get("EMAIL_LOG_REQUESTS", "1") != "0"
+
+class DeadlineExceeded(Exception):
+    pass
+
+def check_deadline(deadline: Optional[float]):
+    """Cooperative time budget: raises once time.time() is past deadline (None = no budget)."""
+    if deadline is not None and time.time() > deadline:
+        raise DeadlineExceeded(f"Deadline exceeded by {time.time() - deadline:.3f}s")
+
+class NerStats:
+    """Counts candidate lines sent to spaCy and lines the gate let skip it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.lines_seen = 0
+        self.ner_lines = 0
+        self.ner_skipped = 0
+
+    def add(self, seen: int, sent: int):
+        with self._lock:
+            self.lines_seen += seen
+            self.ner_lines += sent
+            self.ner_skipped += seen - sent
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"lines_seen": self.lines_seen, "ner_lines": self.ner_lines, "ner_skipped": self.ner_skipped}
+
+ner_stats = NerStats()
+
+def find_pii(text: str) -> List[tuple]:
+    """Regex stage: returns sorted, non-overlapping (start, end, classification, placeholder) spans."""
+    spans = []
+    line_start = scanned = 0
+    for match in PII_REGEX.finditer(text):
+        group = match.lastgroup
+        start, end = match.span()
+        # Name-like pairs in subject lines are kept (e.g. "Subject: Server Outage").
+        # The line start is tracked forward so each character is searched once.
+        if group == 'full_name':
+            newline = text.rfind('\n', scanned, start)
+            if newline >= 0:
+                line_start = newline + 1
+            scanned = start
+            if text.startswith('Subject:', line_start):
+                continue
+        classification, placeholder = PII_TYPES[group]
+        spans.append((start, end, classification, placeholder))
+    return spans
+
+def ner_candidates(text: str, spans: List[tuple]) -> List[tuple[int, str]]:
+    """Lines of the masked output that contain no mask token yet, as (offset, line).
+
+    A span that swallows a newline joins the lines around it, so those lines
+    count as masked. Unmasked lines are identical to the original text, which
+    lets NER offsets be reported against the original input.
+    """
+    candidates = []
+    k = 0
+    line_start = 0
+    spanned = False
+    newlines = [m.start() for m in re.finditer('\n', text)]
+    newlines.append(len(text))
+    for nl in newlines:
+        while k < len(spans) and spans[k][1] <= nl:
+            spanned = True
+            k += 1
+        if k < len(spans) and spans[k][0] <= nl < spans[k][1]:
+            continue
+        line = text[line_start:nl]
+        if not spanned and not MASK_TOKEN_REGEX.search(line):
+            candidates.append((line_start, line))
+        line_start = nl + 1
+        spanned = False
+    return candidates
+
+def could_contain_person(line: str) -> bool:
+    """Cheap gate: only lines with two adjacent capitalized words can yield a kept PERSON.
 
+    Subject lines are never masked by NER, so they are rejected outright.
+    """
+    if line.startswith('Subject:'):
+        return False
+    previous = False
+    for token in line.split():
+        token = token.lstrip('"\'([<')
+        capitalized = bool(token) and token[0].isupper()
+        if capitalized and previous:
+            return True
+        previous = capitalized
+    return False
+
+def gate_candidates(candidates: List[tuple[int, str]], gate: bool = NER_GATE) -> List[tuple[int, str]]:
+    if gate:
+        sent = [candidate for candidate in candidates if could_contain_person(candidate[1])]
+    else:
+        sent = candidates
+    ner_stats.add(len(candidates), len(sent))
+    metrics.inc("email_ner_lines_total", len(sent))
+    metrics.inc("email_ner_skipped_total", len(candidates) - len(sent))
+    return sent
+
+def line_candidates(text: str) -> List[tuple[int, str]]:
+    """Every non-blank line of the original text as (offset, line), for thorough masking."""
+    candidates = []
+    offset = 0
+    for line in text.split('\n'):
+        if line.strip():
+            candidates.append((offset, line))
+        offset += len(line) + 1
+    return candidates
+
+def depth_candidates(text: str, spans: List[tuple], depth: str, gate: bool = NER_GATE) -> List[tuple[int, str]]:
+    if depth == "standard":
+        return gate_candidates(ner_candidates(text, spans), gate)
+    if depth == "thorough":
+        return gate_candidates(line_candidates(text), gate=False)
+    if depth == "fast":
+        return []
+    raise ValueError(f"Unknown masking depth {depth!r}, expected one of {MASK_DEPTHS}")
+
+def merge_spans(spans: List[tuple], extra: List[tuple]) -> List[tuple]:
+    """spans plus every extra span that overlaps none of them; spans must not overlap each other."""
+    if not extra:
+        return spans
+    ordered = sorted(spans)
+    starts = [span[0] for span in ordered]
+    merged = list(spans)
+    for span in extra:
+        # Only the last span starting before this one ends can overlap it
+        i = bisect.bisect_left(starts, span[1])
+        if i == 0 or ordered[i - 1][1] <= span[0]:
+            merged.append(span)
+    return merged
+
+def person_spans(doc, offset: int, skip_subject: bool = True) -> List[tuple]:
+    """NER stage: multi-token PERSON entities of one candidate line as spans."""
+    spans = []
+    if skip_subject and doc.text.startswith('Subject:'):
+        return spans
+    for ent in doc.ents:
+        if ent.label_ == "PERSON" and len(ent.text.split()) >= 2:
+            spans.append((offset + ent.start_char, offset + ent.end_char, 'full_name', '[full_name]'))
+    return spans
+
+def render(text: str, spans: List[tuple]) -> tuple[str, List[Dict]]:
+    """Builds the masked text in one join and the entity list, both from original offsets."""
+    pieces = []
     masked_entities = []
-    
-    def add_entity(start: int, end: int, entity_type: str, entity_value: str):
+    last = 0
+    for start, end, classification, placeholder in sorted(spans):
+        pieces.append(text[last:start])
+        pieces.append(placeholder)
         masked_entities.append({
             "position": [start, end],
-            "classification": entity_type,
-            "entity": entity_value
+            "classification": classification,
+            "entity": text[start:end]
         })
+        last = end
+    pieces.append(text[last:])
+    return ''.join(pieces), masked_entities
 
-    # Initialize masked text
-    masked_text = text
-    offset = 0
+def mask_pii(text: str, nlp, gate: bool = NER_GATE, depth: str = DEFAULT_MASK_DEPTH,
+             deadline: Optional[float] = None) -> tuple[str, List[Dict]]:
+    if not isinstance(text, str):
+        return text, []
 
-    # Apply regex patterns in order of specificity
-    patterns = [
-        (email_pattern, '[email]', 'email'),
-        (aadhar_pattern, '[aadhar_num]', 'aadhar_num'),
-        (credit_debit_pattern, '[credit_debit_no]', 'credit_debit_no'),
-        (dob_pattern, '[dob]', 'dob'),
-        (phone_pattern, '[phone_number]', 'phone_number'),
-        (expiry_pattern, '[expiry_no]', 'expiry_no'),
-        (cvv_pattern, '[cvv_no]', 'cvv_no'),
-        (placeholder_pattern, '[full_name]', 'full_name'),
-    ]
-
-    for pattern, placeholder, entity_type in patterns:
-        matches = list(re.finditer(pattern, masked_text))
-        replacements = []
-        for match in matches:
-            start, end = match.start(), match.end()
-            entity_value = match.group()
-            replacements.append((start, end, placeholder, entity_value))
-            add_entity(start, end, entity_type, entity_value)
-        # Apply replacements in reverse order to preserve positions
-        replacements.sort(key=lambda x: x[0], reverse=True)
-        for start, end, placeholder, _ in replacements:
-            masked_text = masked_text[:start] + placeholder + masked_text[end:]
-
-    # Apply name pattern, skip subjects
-    matches = list(re.finditer(name_pattern, masked_text))
-    replacements = []
-    for match in matches:
-        start, end = match.start(), match.end()
-        entity_value = match.group()
-        # Skip if in subject line or already masked
-        if (not re.match(r'^Subject:.*$', masked_text[:start].split('\n')[-1]) and
-            not re.search(r'\[(full_name|email|phone_number|dob|aadhar_num|credit_debit_no|cvv_no|expiry_no)\]', entity_value)):
-            replacements.append((start, end, '[full_name]', entity_value))
-            add_entity(start, end, 'full_name', entity_value)
-    replacements.sort(key=lambda x: x[0], reverse=True)
-    for start, end, placeholder, _ in replacements:
-        masked_text = masked_text[:start] + placeholder + masked_text[end:]
-
-    # Apply Spacy NER for names not caught by regex
-    lines = masked_text.split('\n')
-    masked_lines = []
-    offset = 0
-    for line in lines:
-        original_line = line
-        if not re.search(r'\[(full_name|email|phone_number|dob|aadhar_num|credit_debit_no|cvv_no|expiry_no)\]', line):
-            doc = nlp(line)
-            replacements = []
-            for ent in doc.ents:
-                if (ent.label_ == "PERSON" and len(ent.text.split()) >= 2 and
-                    not re.match(r'^Subject:.*$', line) and
-                    not re.match(r'\[(full_name|email|phone_number|dob|aadhar_num|credit_debit_no|cvv_no|expiry_no)\]', ent.text)):
-                    start, end = ent.start_char, ent.end_char
-                    replacements.append((start, end, '[full_name]', ent.text))
-                    add_entity(offset + start, offset + end, 'full_name', ent.text)
-            replacements.sort(key=lambda x: x[0], reverse=True)
-            for start, end, placeholder, _ in replacements:
-                line = line[:start] + placeholder + line[end:]
-        masked_lines.append(line)
-        offset += len(original_line) + 1
-
-    masked_text = '\n'.join(masked_lines)
-    return masked_text, masked_entities
\ No newline at end of file
+    with metrics.stage("regex"):
+        spans = find_pii(text)
+        candidates = depth_candidates(text, spans, depth, gate)
+    check_deadline(deadline)
+    if candidates:
+        with metrics.stage("ner"):
+            names = []
+            for (offset, _), doc in zip(candidates, nlp.pipe(line for _, line in candidates)):
+                check_deadline(deadline)
+                names.extend(person_spans(doc, offset, depth != "thorough"))
+            # Standard candidates hold no spans yet; thorough lines may overlap regex matches
+            spans = merge_spans(spans, names) if depth == "thorough" else spans + names
+    with metrics.stage("render"):
+        return render(text, spans)
+
+def mask_pii_batch(texts: List[str], nlp, batch_size: int = NER_BATCH_SIZE, gate: bool = NER_GATE,
+                   depth: str = DEFAULT_MASK_DEPTH, deadline: Optional[float] = None) -> List[tuple[str, List[Dict]]]:
+    """Batched mask_pii: every NER candidate line of every email goes through one nlp.pipe."""
+    staged = []
+    lines = []
+    with metrics.stage("regex_batch"):
+        for text in texts:
+            if not isinstance(text, str):
+                staged.append((text, None, []))
+                continue
+            spans = find_pii(text)
+            candidates = depth_candidates(text, spans, depth, gate)
+            staged.append((text, spans, candidates))
+            check_deadline(deadline)
+            lines.extend(line for _, line in candidates)
+
+    with metrics.stage("ner_batch"):
+        docs = []
+        for doc in (nlp.pipe(lines, batch_size=batch_size) if lines else []):
+            check_deadline(deadline)
+            docs.append(doc)
+
+    results = []
+    docs = iter(docs)
+    with metrics.stage("render_batch"):
+        for text, spans, candidates in staged:
+            if spans is None:
+                results.append((text, []))
+                continue
+            names = [span for offset, _ in candidates for span in person_spans(next(docs), offset, depth != "thorough")]
+            spans = merge_spans(spans, names) if depth == "thorough" else spans + names
+            results.append(render(text, spans))
+    return results
@@ -1,66 +1,119 @@
 # validate_pii.py
 # Validates PII masking in emails_masked.csv
 # Aligned regex, added exclusions for Postgre, My
+# Column-wide matching with precompiled patterns, parallel over row ranges, JSONL leak report
+# Loads only email_masked, from the columnar store when there is one (datastore.py)
 # Author: Dhanush
 # Date: April 19, 2025
 
 import pandas as pd
 import re
+import os
+import json
+import argparse
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from datastore import read_columns
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 phone_pattern = r'\b(?:\+?\d{1,4}[-.\s]?)?(?:\(\d{1,4}\)|[\d-]{1,4})?[-.\s]?\d{3,4}[-.\s]?\d{3,4}(?:[-.\s]?\d{3,4})?\b|\b\d{10,12}\b|<tel_num>'
-email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
+email_pattern = r'\b[A-Za-z0-9._%+-]{1,64}@[A-Za-z0-9.-]{1,253}\.[A-Z|a-z]{2,63}\b'  # bounded: linear scan
 name_pattern = r'\b[A-Z][a-z]{2,}\s[A-Z][a-z]{2,}\b'
 
+LEAK_PATTERNS = {
+    "phone": re.compile(phone_pattern),
+    "email": re.compile(email_pattern),
+    "name": re.compile(name_pattern),
+}
+MASK_TOKEN_REGEX = re.compile(r'\[\[NAME\]\]|\[PHONE\]|\[EMAIL\]|\[NAME\]')
+NAME_EXCLUSIONS = frozenset({
+    "Customer Support", "Dear Customer", "Concerns About", "Securing Medical",
+    "Book Air", "Project Management", "Best Regards", "Pro You", "Security Hospital",
+    "Excel You", "Outlook You", "Server Integration", "Server You", "Postgre SQL",
+    "My Name", "Jane Smith", "John Doe", "Elena Ivanova"
+})
+SNIPPET_CONTEXT = 30
+
+def _blank_tokens(match):
+    # Same-length filler keeps spans aligned with email_masked and stops
+    # text on either side of a token from joining into a new match
+    return '#' * len(match.group())
+
+def find_leaks(texts: pd.Series) -> list:
+    """Unmasked PII in a column of masked emails as (row, entity type, span, snippet) records."""
+    texts = texts.dropna().astype(str)
+    clean = texts.str.replace(MASK_TOKEN_REGEX, _blank_tokens, regex=True)
+    leaks = []
+    for entity_type, regex in LEAK_PATTERNS.items():
+        # Vectorized pre-filter; spans are only extracted from rows that hit
+        hits = clean[clean.str.contains(regex)]
+        for row, text in hits.items():
+            for match in regex.finditer(text):
+                if entity_type == "name" and match.group() in NAME_EXCLUSIONS:
+                    continue
+                start, end = match.span()
+                leaks.append({
+                    "row": int(row),
+                    "entity_type": entity_type,
+                    "span": [start, end],
+                    "match": match.group(),
+                    "snippet": texts[row][max(0, start - SNIPPET_CONTEXT):end + SNIPPET_CONTEXT]
+                })
+    leaks.sort(key=lambda leak: (leak["row"], leak["span"][0]))
+    return leaks
+
 def validate_pii(text, row_idx):
     issues = []
     if not isinstance(text, str):
         return issues
-
-    text_clean = re.sub(r'\[PHONE\]|\[EMAIL\]|\[NAME\]|\[\[NAME\]\]', '', text)
-
-    phone_matches = re.finditer(phone_pattern, text_clean)
-    for match in phone_matches:
-        issues.append(f"Phone not masked in row {row_idx}: {match.group()}")
-
-    email_matches = re.finditer(email_pattern, text_clean)
-    for match in email_matches:
-        issues.append(f"Email not masked in row {row_idx}: {match.group()}")
-
-    name_matches = re.finditer(name_pattern, text_clean)
-    for match in name_matches:
-        if match.group() not in [
-            "Customer Support", "Dear Customer", "Concerns About", "Securing Medical",
-            "Book Air", "Project Management", "Best Regards", "Pro You", "Security Hospital",
-            "Excel You", "Outlook You", "Server Integration", "Server You", "Postgre SQL",
-            "My Name", "Jane Smith", "John Doe", "Elena Ivanova"
-        ]:
-            issues.append(f"Name not masked in row {row_idx}: {match.group()}")
-
+    for leak in find_leaks(pd.Series([text], index=[row_idx])):
+        issues.append(f"{leak['entity_type'].capitalize()} not masked in row {row_idx}: {leak['match']}")
     return issues
 
+def find_leaks_parallel(texts: pd.Series, workers: int) -> list:
+    if workers <= 1 or len(texts) < 2 * workers:
+        return find_leaks(texts)
+    step = -(-len(texts) // workers)
+    parts = [texts.iloc[i:i + step] for i in range(0, len(texts), step)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(find_leaks, parts)
+    return [leak for part in results for leak in part]
+
 def main():
+    parser = argparse.ArgumentParser(description="Validate PII masking in emails_masked.csv")
+    parser.add_argument("--input", default="emails_masked.csv")
+    parser.add_argument("--report", default="pii_leaks.jsonl", help="one JSON record per leak")
+    parser.add_argument("--max-leaks", type=int, default=0, help="exit 1 when more leaks than this are found")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
     try:
-        df = pd.read_csv("emails_masked.csv")
+        df = read_columns(args.input, ["email_masked"])
         logger.info(f"Validating PII masking for {len(df)} rows")
     except Exception as e:
         logger.error(f"Error loading dataset: {e}")
         exit(1)
 
-    issues = []
-    for idx, row in df.iterrows():
-        row_issues = validate_pii(row["email_masked"], idx)
-        issues.extend(row_issues)
+    leaks = find_leaks_parallel(df["email_masked"], args.workers)
+
+    try:
+        with open(args.report, "w") as f:
+            for leak in leaks:
+                f.write(json.dumps(leak, ensure_ascii=False) + "\n")
+    except Exception as e:
+        logger.error(f"Error writing report: {e}")
+        exit(1)
 
-    if issues:
-        for issue in issues[:10]:
-            logger.warning(issue)
-        logger.info(f"Validation complete. {len(issues)} potential PII issues found.")
-    else:
-        logger.info("Validation complete. 0 potential PII issues found.")
+    for leak in leaks[:10]:
+        logger.warning(f"{leak['entity_type'].capitalize()} not masked in row {leak['row']}: {leak['match']}")
+    counts = pd.Series([leak["entity_type"] for leak in leaks], dtype=object).value_counts().to_dict()
+    logger.info(f"Validation complete. {len(leaks)} potential PII issues found {counts}. Report: {args.report}")
+
+    if len(leaks) > args.max_leaks:
+        logger.error(f"{len(leaks)} leaks exceed the threshold of {args.max_leaks}")
+        exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,25 +1,30 @@
 # verify_pii.py
 # Verifies PII masking for specific rows and data integrity
+# Reads the checked rows and the type columns only, via the columnar store (datastore.py)
 # Author: Dhanush
 # Date: April 19, 2025
 
 import pandas as pd
+from datastore import read_rows, read_columns, dataset_shape
 
 pd.set_option('display.max_colwidth', None)
 
+rows_to_check = [5, 64, 23778, 23818]
 try:
-    masked = pd.read_csv("emails_masked.csv")
-    original = pd.read_csv("emails.csv")
+    rows = read_rows("emails_masked.csv", rows_to_check, ["email", "email_masked"])
+    masked_types = read_columns("emails_masked.csv", ["type"])["type"]
+    original_types = read_columns("emails.csv", ["type"])["type"]
+    shape = dataset_shape("emails_masked.csv")
 except Exception as e:
     print(f"Error loading datasets: {e}")
     exit(1)
 
-rows_to_check = [5, 64, 23778, 23818]
 for row in rows_to_check:
-    print(f"Row {row}:\n", masked.loc[row, ["email", "email_masked"]])
-    print()
+    if row in rows.index:
+        print(f"Row {row}:\n", rows.loc[row, ["email", "email_masked"]])
+        print()
 
-print("Shape:", masked.shape)
-print("Type counts:\n", masked["type"].value_counts())
-print("Original type counts:\n", original["type"].value_counts())
-print("Type columns match:", (original["type"] == masked["type"]).all())
\ No newline at end of file
+print("Shape:", shape)
+print("Type counts:\n", masked_types.value_counts())
+print("Original type counts:\n", original_types.value_counts())
+print("Type columns match:", (original_types == masked_types).all())
\ No newline at end of file
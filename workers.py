@@ -0,0 +1,223 @@
+# workers.py
+# Process-pool execution layer for masking and classification
+# Keeps CPU-bound spaCy / Random Forest work off the FastAPI event loop
+# Author: Dhanush
+# Date: April 19, 2025
+
+import os
+import time
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Optional
+from metrics import REGISTRY as metrics
+from utils import DEFAULT_MASK_DEPTH
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Worker processes; 0 runs inference in a thread of the server process instead
+POOL_SIZE = int(os.environ.get("EMAIL_POOL_SIZE", os.cpu_count() or 1))
+# Requests queued or running in the pool before new ones are rejected
+MAX_IN_FLIGHT = int(os.environ.get("EMAIL_MAX_IN_FLIGHT", max(POOL_SIZE, 1) * 4))
+# Seconds a pool may take until every worker has loaded its models
+WARM_UP_TIMEOUT = float(os.environ.get("EMAIL_WARM_UP_TIMEOUT", 600))
+
+# Shared by the workers of one pool; set by the initializer
+_warm_barrier = None
+
+class PoolSaturated(Exception):
+    pass
+
+class PoolRestarting(PoolSaturated):
+    pass
+
+class ReloadInProgress(Exception):
+    pass
+
+def _init_worker(model_config: Optional[Dict] = None, barrier=None):
+    # Loads and warms the Spacy model and rf_model.pkl once per worker
+    global _warm_barrier
+    _warm_barrier = barrier
+    version = _warm_up_in_process(model_config)
+    logger.info(f"Inference worker {os.getpid()} ready, model version {version}")
+
+def _ping(timeout: float = WARM_UP_TIMEOUT) -> tuple[int, str]:
+    # A warm worker would otherwise answer every ping while the others are still loading;
+    # the barrier holds each one until all workers of the pool have taken a ping
+    if _warm_barrier is not None:
+        _warm_barrier.wait(timeout)
+    from pipeline import model_holder
+    return os.getpid(), model_holder.version
+
+def _warm_up_in_process(model_config: Optional[Dict] = None) -> str:
+    """Warms the current models; with a model_config (ModelHolder arguments, possibly
+    empty) loads and warms a fresh set from disk and switches to it instead."""
+    import pipeline
+    if model_config is None:
+        pipeline.model_holder.warm_up()
+    else:
+        holder = pipeline.ModelHolder(**model_config)
+        holder.warm_up()
+        pipeline.install_models(holder)
+    return pipeline.model_holder.version
+
+# Worker tasks return their metric samples so the server process can replay them
+def _classify(email: str, depth: str, deadline: Optional[float]) -> tuple[Dict, list]:
+    from pipeline import classify_email
+    with metrics.capture() as samples:
+        result = classify_email(email, depth=depth, deadline=deadline)
+    return result, samples
+
+def _classify_batch(emails: List[str], batch_size: int, depth: str, deadline: Optional[float]) -> tuple[List[Dict], list]:
+    from pipeline import classify_emails
+    with metrics.capture() as samples:
+        results = classify_emails(emails, batch_size=batch_size, depth=depth, deadline=deadline)
+    return results, samples
+
+class InferencePool:
+    def __init__(self, size: int = POOL_SIZE, max_in_flight: int = MAX_IN_FLIGHT):
+        self.size = size
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.executor = None
+        self.ready = False
+        self.error = None
+        self.model_version = None
+        # ModelHolder arguments of the last reload; None serves the EMAIL_* defaults
+        self.model_config = None
+        self.reloading = False
+        self.reload_error = None
+        self.reloaded_at = None
+        self._restart = None
+
+    def _new_executor(self, model_config: Optional[Dict]) -> ProcessPoolExecutor:
+        context = multiprocessing.get_context("spawn")
+        # Synchronization primitives reach spawned workers only through initargs
+        return ProcessPoolExecutor(
+            max_workers=self.size,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(model_config, context.Barrier(self.size))
+        )
+
+    def start(self):
+        if self.size > 0 and self.executor is None:
+            self.executor = self._new_executor(self.model_config)
+            logger.info(f"Started inference pool with {self.size} workers, max {self.max_in_flight} in flight")
+
+    async def _warm(self, executor: Optional[ProcessPoolExecutor], model_config: Optional[Dict]) -> str:
+        if executor is None:
+            return await asyncio.to_thread(_warm_up_in_process, model_config)
+        # One ping per worker: each blocks on the pool's barrier until every worker
+        # has finished its initializer and taken a ping, so all of them are warm
+        futures = [asyncio.wrap_future(executor.submit(_ping)) for _ in range(self.size)]
+        workers = await asyncio.gather(*futures)
+        if len({pid for pid, _ in workers}) != self.size:
+            raise RuntimeError(f"Expected {self.size} warm workers, got pings from {sorted(pid for pid, _ in workers)}")
+        versions = {version for _, version in workers}
+        if len(versions) != 1:
+            raise RuntimeError(f"Workers loaded different model versions: {sorted(versions)}")
+        version = versions.pop()
+        logger.info(f"Inference workers warm: {sorted(pid for pid, _ in workers)}, model version {version}")
+        return version
+
+    async def warm_up(self):
+        """Waits until every worker has loaded and warmed its models; sets ready or error."""
+        try:
+            self.model_version = await self._warm(self.executor, self.model_config)
+            self.ready, self.error = True, None
+        except Exception as e:
+            self.error = str(e) or type(e).__name__
+            logger.error(f"Inference pool warm-up failed: {self.error}")
+
+    async def reload(self, **overrides) -> str:
+        """Loads and warms the models again from disk next to the serving ones, then switches to them.
+
+        overrides (model_path, cascade_path, spacy_model, cascade_threshold) replace
+        the current settings. With worker processes a second pool is started and
+        warmed; requests already submitted finish on the old pool, which exits
+        once they have. Without workers a new ModelHolder is swapped in. If
+        loading fails, the serving models stay in place and the error is raised.
+        """
+        if self.reloading:
+            raise ReloadInProgress("A model reload is already running")
+        self.reloading = True
+        model_config = {**(self.model_config or {}), **{key: value for key, value in overrides.items() if value is not None}}
+        executor = self._new_executor(model_config) if self.size > 0 else None
+        try:
+            try:
+                version = await self._warm(executor, model_config)
+            except Exception as e:
+                if executor is not None:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                self.reload_error = str(e) or type(e).__name__
+                metrics.inc("email_model_reloads_total", result="failed")
+                logger.error(f"Model reload failed, still serving {self.model_version}: {self.reload_error}")
+                raise
+            previous, old_executor = self.model_version, self.executor
+            if executor is not None:
+                self.executor = executor
+            self.model_version, self.model_config = version, model_config
+            self.ready, self.error, self.reload_error = True, None, None
+            self.reloaded_at = time.time()
+            metrics.inc("email_model_reloads_total", result="ok")
+            logger.info(f"Switched from model version {previous} to {version}")
+            if old_executor is not None and executor is not None:
+                await asyncio.to_thread(old_executor.shutdown, True)
+            return version
+        finally:
+            self.reloading = False
+
+    def _replace_broken(self, broken: ProcessPoolExecutor):
+        """Swaps a pool whose worker died (OOM kill, segfault) for a fresh one; not ready until it is warm."""
+        if broken is not self.executor:
+            return  # another request already replaced it
+        self.ready = False
+        self.error = "An inference worker died; restarting the pool"
+        logger.error(self.error)
+        metrics.inc("email_pool_restarts_total")
+        self.executor = self._new_executor(self.model_config)
+        broken.shutdown(wait=False, cancel_futures=True)
+        self._restart = asyncio.create_task(self.warm_up())
+
+    def shutdown(self):
+        if self._restart is not None:
+            self._restart.cancel()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    async def _run_captured(self, fn, *args):
+        result, samples = await self.run(fn, *args)
+        metrics.replay(samples)
+        return result
+
+    async def run(self, fn, *args):
+        # Only touched from the event loop thread, so the counter needs no lock
+        if self.in_flight >= self.max_in_flight:
+            raise PoolSaturated(f"{self.in_flight} requests in flight (limit {self.max_in_flight})")
+        self.in_flight += 1
+        try:
+            if self.executor is None:
+                return await asyncio.to_thread(fn, *args)
+            executor = self.executor
+            try:
+                return await asyncio.wrap_future(executor.submit(fn, *args))
+            except BrokenProcessPool as e:
+                self._replace_broken(executor)
+                raise PoolRestarting("Inference pool restarting after a worker died") from e
+        finally:
+            self.in_flight -= 1
+
+    # deadline is an absolute time.time(); workers stop at their next check once it passes
+    async def classify(self, email: str, depth: str = DEFAULT_MASK_DEPTH, deadline: Optional[float] = None) -> Dict:
+        return await self._run_captured(_classify, email, depth, deadline)
+
+    async def classify_batch(self, emails: List[str], batch_size: int, depth: str = DEFAULT_MASK_DEPTH,
+                             deadline: Optional[float] = None) -> List[Dict]:
+        return await self._run_captured(_classify_batch, emails, batch_size, depth, deadline)
+
+inference_pool = InferencePool()